@@ -0,0 +1,388 @@
+"""
+Micro-benchmarks of the bot's hot paths.
+
+    python benchmarks/bench.py                  # run, print JSON, compare with benchmarks/baseline.json
+    python benchmarks/bench.py --save-baseline  # run and store the results as the new baseline
+    python benchmarks/bench.py -k numbers       # only benchmarks with 'numbers' as a component of their dotted name
+    python benchmarks/bench.py --repeat 3       # median of three runs of the suite, steadier on noisy machines
+
+Times are seconds per operation (best of several rounds). The run exits with code 1
+if a benchmark is slower than its baseline by more than --threshold.
+Track generation benchmarks use a local fake TTS engine and need ffmpeg, they are skipped without it.
+"""
+import sys
+import json
+import math
+import time
+import struct
+import wave
+import random
+import shutil
+import asyncio
+import argparse
+import pathlib
+import platform
+import tempfile
+import importlib
+import statistics
+from types import SimpleNamespace
+from dataclasses import asdict
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+PACKAGE = 'daily-language-bot'
+BASELINE_PATH = pathlib.Path(__file__).resolve().parent / 'baseline.json'
+DEFAULT_THRESHOLD = 0.5 # allowed slowdown against the baseline, shared machines easily vary by a third
+ROUNDS = 7
+SIZES = (1_000, 10_000, 100_000)
+SEED = 20240101
+
+
+def _module(name: str):
+    return importlib.import_module(f'{PACKAGE}.{name}')
+
+
+def measure(func, number: int = 1, rounds: int = ROUNDS) -> float:
+    """
+    Best seconds per call of func over rounds of number calls (the minimum is the least disturbed by other load).
+    """
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings)
+
+
+class _NoJobQueue:
+    """
+    Job queue stand-in: benchmarks call the jobs themselves.
+    """
+    def run_repeating(self, *args, **kwargs):
+        pass
+
+    def run_once(self, *args, **kwargs):
+        pass
+
+
+def _context():
+    return SimpleNamespace(job_queue=_NoJobQueue(), bot=None, bot_data={}, create_task=asyncio.ensure_future)
+
+
+def _random_subs(count: int, rng: random.Random) -> list[tuple[int, object]]:
+    SubInfo = _module('sub_storage').SubInfo
+    return [(rng.randrange(10**6, 10**10), SubInfo(rng.choice(['numbers', 'verbs']), rng.choice(['DE', 'EN']),
+                                                      rng.randrange(24), rng.randrange(60), rng.randrange(-11, 13)))
+            for _ in range(count)]
+
+
+def _fill_storage(kind: str, data_dir: pathlib.Path, rows: list):
+    storage = _module('sub_storage')
+    if kind == 'json':
+        subs = {}
+        for chat_id, info in rows:
+            subs.setdefault(str(chat_id), []).append(asdict(info))
+        with open(data_dir / 'subs.json', 'w', encoding='utf-8') as f:
+            json.dump({'seq': 0, 'subs': subs}, f)
+    else:
+        db = storage.SqliteStorage(data_dir)
+        db.insert_many(rows)
+        db.close()
+
+
+def _measure_restore_rest(SubManager, open_storage, data_dir: pathlib.Path, rounds: int = 3) -> float:
+    # Every round needs a fresh manager, whose construction (the eager restore) is not timed
+    loop = asyncio.new_event_loop()
+    timings = []
+    try:
+        for _ in range(rounds):
+            manager = SubManager(data_dir, _context(), open_storage())
+            context = SimpleNamespace(job=SimpleNamespace(data=SubManager.EAGER_RESTORE_MINUTES))
+            start = time.perf_counter()
+            loop.run_until_complete(manager._restore_rest_job(context))
+            timings.append(time.perf_counter() - start)
+            manager.storage.close()
+    finally:
+        loop.close()
+    return min(timings)
+
+
+def bench_sub_manager(results: dict, selected):
+    SubManager = _module('sub_manager').SubManager
+    open_storage = _module('sub_storage').open_storage
+    rng = random.Random(SEED)
+
+    for kind in ('json', 'sqlite'):
+        for size in SIZES:
+            prefix = f'sub_manager.{kind}.{size}'
+            if not selected(prefix):
+                continue
+            with tempfile.TemporaryDirectory() as tmp:
+                data_dir = pathlib.Path(tmp)
+                rows = _random_subs(size, rng)
+                _fill_storage(kind, data_dir, rows)
+
+                # Startup restores the next hours only, the rest of the day follows in a job
+                def restore():
+                    manager = SubManager(data_dir, _context(), open_storage(kind, data_dir))
+                    manager.storage.close()
+                results[f'{prefix}.restore'] = measure(restore, rounds=3)
+                results[f'{prefix}.restore_rest'] = _measure_restore_rest(SubManager, lambda: open_storage(kind, data_dir), data_dir)
+
+                manager = SubManager(data_dir, _context(), open_storage(kind, data_dir))
+                chat_ids = [chat_id for chat_id, _ in rows]
+                results[f'{prefix}.get'] = measure(lambda: manager.get_subs(rng.choice(chat_ids)), number=1000)
+                results[f'{prefix}.has'] = measure(lambda: manager.has_sub(rng.choice(chat_ids), 'numbers', 'DE'), number=1000)
+
+                # Every mutation is durable (fsync/commit), so fewer of them
+                new_subs = iter(_random_subs(ROUNDS * 50, rng))
+                added = []
+
+                def add():
+                    chat_id, info = next(new_subs)
+                    manager.add_sub(chat_id, info)
+                    added.append((chat_id, info))
+                results[f'{prefix}.add'] = measure(add, number=50)
+
+                def remove():
+                    chat_id, info = added.pop()
+                    manager.remove_sub(chat_id, info.task)
+                results[f'{prefix}.remove'] = measure(remove, number=50)
+                manager.storage.close()
+
+
+def _numbers_answer(exercise, language: str) -> str:
+    NUMBERS = _module('numbers_de').NUMBERS
+    return '\n'.join([NUMBERS[language][n] for n in exercise.numerical] + [str(n) for n in exercise.text] + [str(n) for n in exercise.audio])
+
+
+def bench_checks(results: dict, selected):
+    checks = _module('checks')
+    jobs = _module('jobs')
+    rng = random.Random(SEED)
+
+    class Message:
+        chat_id = 1
+        text = ''
+
+        async def reply_text(self, text, **kwargs):
+            pass
+
+    for language in ('DE', 'EN'):
+        if not selected(f'checks.numbers.{language}'):
+            continue
+        exercises = [jobs.make_numbers_exercise(language, rng) for _ in range(100)]
+        answers = [_numbers_answer(exercise, language) for exercise in exercises]
+        results[f'checks.numbers.{language}.parse'] = measure(
+            lambda: [checks.parse_numbers_answer(answer, language) for answer in answers], rounds=ROUNDS) / len(answers)
+
+        message = Message()
+
+        async def check_all():
+            for exercise, answer in zip(exercises, answers):
+                message.text = answer
+                await checks.check_numbers_task(SimpleNamespace(message=message), 1, exercise)
+        results[f'checks.numbers.{language}.check'] = measure(lambda: asyncio.run(check_all())) / len(answers)
+
+
+def bench_numbers_import(results: dict, selected):
+    if not selected('numbers.import'):
+        return
+    numbers_de = _module('numbers_de')
+    results['numbers.import'] = measure(lambda: importlib.reload(numbers_de), number=20)
+
+    def words_and_values():
+        for lexicon in numbers_de.LEXICONS.values():
+            lexicon.words.cache_clear()
+            lexicon._forms.cache_clear()
+            for n in numbers_de.NUMBER_RANGE:
+                lexicon.value(lexicon.words(n))
+    results['numbers.round_trip_range'] = measure(words_and_values)
+
+
+def _fake_tts(text: str, lang: str, mp3_path: str):
+    # A short tone instead of speech, ffmpeg reads the WAV regardless of the file name
+    rate, seconds = 24000, 0.3 + 0.02 * len(text)
+    frequency = 300 + 10 * (sum(map(ord, text)) % 50)
+    frames = bytearray()
+    for i in range(int(rate * seconds)):
+        sample = int(8000 * math.sin(2 * math.pi * frequency * i / rate))
+        frames += sample.to_bytes(2, 'little', signed=True)
+    with wave.open(mp3_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(bytes(frames))
+
+
+def _synthetic_opus(seconds: float, packet_size: int = 60, packets_per_page: int = 50) -> bytes:
+    """
+    Ogg/Opus stream with the page layout of an encoded track and random payload, as far as reading its duration goes.
+    CRCs are left zero, the duration reader does not check them.
+    """
+    ogg = _module('ogg')
+    serial, pre_skip, samples_per_packet = 0x5eed, 312, 960 # 20 ms packets
+    rng = random.Random(SEED)
+    pages = []
+
+    def page(header_type: int, granule: int, packets: list[bytes]):
+        lacing = bytearray()
+        for packet in packets:
+            lacing += b'\xff' * (len(packet) // 255) + bytes([len(packet) % 255])
+        header = ogg.PAGE_HEADER.pack(ogg.OGG_CAPTURE, 0, header_type, granule, serial, len(pages), 0, len(lacing))
+        pages.append(header + lacing + b''.join(packets))
+
+    page(2, 0, [ogg.OPUS_HEAD + struct.pack('<BBHIhB', 1, 1, pre_skip, 48000, 0, 0)])
+    page(0, 0, [b'OpusTags' + struct.pack('<I', 5) + b'bench' + struct.pack('<I', 0)])
+    packets = math.ceil((seconds * ogg.OPUS_GRANULE_RATE + pre_skip) / samples_per_packet)
+    granule = 0
+    for first in range(0, packets, packets_per_page):
+        count = min(packets_per_page, packets - first)
+        granule += count * samples_per_packet
+        page(4 if first + count == packets else 0, granule, [rng.randbytes(packet_size) for _ in range(count)])
+    return b''.join(pages)
+
+
+def bench_audio(results: dict, selected, skipped: list):
+    if not selected('audio'):
+        return
+    audio = _module('audio')
+    # The duration is read in-process, a synthesized stream keeps it measured where ffmpeg is missing
+    content = _synthetic_opus(5)
+    assert abs(asyncio.run(audio.get_duration('bench.ogg', content)) - 5) < 0.02
+    with tempfile.TemporaryDirectory() as tmp:
+        path = pathlib.Path(tmp) / 'bench.ogg'
+        path.write_bytes(content)
+        results['audio.get_duration'] = asyncio.run(_measure_async(lambda: audio.get_duration('bench.ogg', content), number=100))
+        results['audio.get_duration.file'] = asyncio.run(_measure_async(lambda: audio.get_duration(str(path)), number=100))
+
+    if shutil.which('ffmpeg') is None:
+        skipped.append('audio.generate_voice_track')
+        return
+    audio._synthesize = _fake_tts
+    NUMBERS = _module('numbers_de').NUMBERS
+    words = [NUMBERS['DE'][n] for n in (7, 21, 58)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        async def track() -> str:
+            return await audio.generate_voice_track(words, tmp, 'de')
+
+        async def cold():
+            # Clips are synthesized and encoded on the first track only
+            _module('clip_cache').get_clip_cache.cache_clear()
+            shutil.rmtree(pathlib.Path(tmp) / 'clips', ignore_errors=True)
+            pathlib.Path(await track()).unlink()
+
+        async def run_all():
+            results['audio.generate_voice_track.cold'] = await _measure_async(cold, rounds=3)
+            path = await track()
+            results['audio.generate_voice_track.cached'] = await _measure_async(lambda: _unlink_after(track()))
+            pathlib.Path(path).unlink()
+
+        asyncio.run(run_all())
+
+
+async def _unlink_after(track):
+    pathlib.Path(await track).unlink()
+
+
+async def _measure_async(func, number: int = 1, rounds: int = ROUNDS) -> float:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings)
+
+
+def bench_conversations(results: dict, selected):
+    if not selected('conversations'):
+        return
+    import warnings
+    manager = SimpleNamespace()
+    classes = [
+        _module('subscribe_conversation').SubConversation,
+        _module('unsubscibe_conversation').UnsubConversation,
+        _module('edit_conversation').EditConversation,
+    ]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # per_message warnings of python-telegram-bot
+        results['conversations.construct'] = measure(lambda: [cls(manager) for cls in classes], number=20)
+
+
+BENCHMARKS = [bench_sub_manager, bench_checks, bench_numbers_import, bench_conversations]
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, seconds in results.items():
+        base = baseline.get(name)
+        if base and seconds > base * (1 + threshold):
+            regressions.append(f'{name}: {seconds:.3g}s vs baseline {base:.3g}s (+{(seconds / base - 1) * 100:.0f}%)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the bot hot paths')
+    parser.add_argument('-k', dest='keyword', default='', help='run only benchmarks whose dotted name contains these whole components, e.g. sub_manager.json.1000')
+    parser.add_argument('--baseline', type=pathlib.Path, default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'allowed relative slowdown against the baseline (default: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--repeat', type=int, default=1, help='run the suite this many times and report the medians')
+    parser.add_argument('-o', '--output', type=pathlib.Path, help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    keyword = args.keyword.split('.') if args.keyword else []
+
+    def selected(name: str) -> bool:
+        # Dotted components match whole: 'sub_manager.json.1000' is not part of 'sub_manager.json.10000'.
+        # A group is also run when the keyword names one of its benchmarks
+        parts = name.split('.')
+        return (any(parts[i:i + len(keyword)] == keyword for i in range(len(parts) - len(keyword) + 1))
+                or keyword[:len(parts)] == parts)
+
+    runs = []
+    for _ in range(max(1, args.repeat)):
+        run = {}
+        for bench in BENCHMARKS:
+            bench(run, selected)
+        runs.append(run)
+    results = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    # Dominated by ffmpeg and run once
+    skipped = []
+    bench_audio(results, selected, skipped)
+    results = {name: results[name] for name in sorted(results) if selected(name)}
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'unit': 'seconds per operation',
+        'results': results,
+        'skipped': skipped,
+    }
+
+    baseline = {}
+    if args.baseline.exists():
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    regressions = [] if args.save_baseline else compare(results, baseline, args.threshold)
+    report['regressions'] = regressions
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        args.output.write_text(text + '\n', encoding='utf-8')
+    if args.save_baseline:
+        merged = {**baseline, **results}
+        args.baseline.write_text(json.dumps({**report, 'results': merged, 'regressions': []}, indent=2) + '\n', encoding='utf-8')
+    if regressions:
+        print('\n'.join(['Regressions:'] + regressions), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""
+End-to-end load simulation: the real Bot against a local fake Telegram Bot API.
+
+    python benchmarks/loadsim.py --subscribers 5000 --minutes 3 --sessions-per-second 5
+
+Subscribers are spread over the day like real users (most at the default 12:00 GMT+0) and the part
+of the day around 12:00 is replayed compressed: with --speed 60 every real minute stands for an hour.
+Next to the deliveries, new users go through /subscribe and /list and some subscribers answer their exercise.
+The report (JSON) has the delivery lag per scheduled minute, handler latency percentiles and peak memory.
+Audio still goes through ffmpeg, speech is replaced by a local fake TTS engine (see bench.py) and
+the clip cache is warmed up before the run, so the deliveries measure the steady state.
+"""
+import os
+import re
+import sys
+import json
+import time
+import queue
+import random
+import signal
+import shutil
+import argparse
+import pathlib
+import resource
+import tempfile
+import threading
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import dataclass, field
+
+from bench import PACKAGE, SEED, _module, _fill_storage, _fake_tts
+
+MINUTES_PER_DAY = 24 * 60
+PEAK_MINUTE = 12 * 60 # 12:00 GMT+0, the default offered by /subscribe
+RESPONSE_TIMEOUT = 30 # seconds a simulated user waits for the bot
+SUBSCRIBER_CHATS = 10**9 # subscriber chat ids start here, new users of sessions below
+LONG_POLL_CAP = 1.0 # seconds getUpdates waits at most, so shutdown is quick
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values: list[float]) -> dict:
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+class FakeBotAPI:
+    """
+    Stand-in for api.telegram.org: serves getUpdates from a local queue and records what the bot sends.
+    """
+
+    def __init__(self):
+        self.updates: list[dict] = []
+        self._next_update_id = 1
+        self._cond = threading.Condition()
+        self.calls: dict[str, int] = {}
+        self.voices: dict[int, float] = {} # chat_id -> time of the last voice message
+        self._responses: dict[int, queue.Queue] = {}
+        self._message_id = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+
+    def responses(self, chat_id: int) -> queue.Queue:
+        with self._cond:
+            return self._responses.setdefault(chat_id, queue.Queue())
+
+
+    def push(self, update: dict) -> float:
+        with self._cond:
+            update['update_id'] = self._next_update_id
+            self._next_update_id += 1
+            self.updates.append(update)
+            self._cond.notify_all()
+        return time.monotonic()
+
+
+    def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get('offset', 0))
+        deadline = time.monotonic() + min(float(params.get('timeout', 0)), LONG_POLL_CAP)
+        with self._cond:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self.updates[:100])
+
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        with self._cond:
+            self._message_id += 1
+            message_id = self._message_id
+        return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, **extra}
+
+
+    def handle(self, method: str, params: dict):
+        now = time.monotonic()
+        with self._cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+        if chat_id is not None:
+            self.responses(chat_id).put((now, method))
+
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'loadsim', 'username': 'loadsim_bot'}
+        if method == 'sendVoice':
+            self.voices[chat_id] = now
+            return self._message(chat_id, voice={'file_id': f'voice{chat_id}', 'file_unique_id': f'u{chat_id}', 'duration': 5})
+        if method in ('sendMessage', 'editMessageText'):
+            return self._message(chat_id, text=params.get('text', ''))
+        return True
+
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('multipart/'):
+                    # Only the plain fields are of interest, not the uploaded file
+                    params = dict(re.findall(rb'name="(\w+)"\r\n\r\n([^\r]*)\r\n', body))
+                    params = {key.decode(): value.decode(errors='replace') for key, value in params.items()}
+                elif content_type.startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                out = json.dumps({'ok': True, 'result': api.handle(method, params)}).encode()
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(out)))
+                    self.end_headers()
+                    self.wfile.write(out)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass # the bot gave up on a long poll while shutting down
+
+        return Handler
+
+
+    def close(self):
+        self.server.shutdown()
+
+
+def _user(chat_id: int) -> dict:
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+
+
+def message_update(chat_id: int, text: str) -> dict:
+    message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'from': _user(chat_id), 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': message}
+
+
+def callback_update(chat_id: int, data: str) -> dict:
+    message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'text': '...'}
+    return {'callback_query': {'id': f'{chat_id}-{time.monotonic_ns()}', 'from': _user(chat_id), 'chat_instance': str(chat_id),
+                               'data': data, 'message': message}}
+
+
+def sample_slot(rng: random.Random) -> tuple[int, int]:
+    """
+    (UTC minute of the day, timezone) of a subscriber: most keep the default 12:00 GMT+0,
+    others pick round local times around midday, some any time of the day.
+    """
+    kind = rng.random()
+    if kind < 0.5:
+        return PEAK_MINUTE, 0
+    timezone = rng.randint(-5, 3)
+    if kind < 0.85:
+        local = int(rng.gauss(PEAK_MINUTE, 120)) // 30 * 30
+    else:
+        local = rng.randrange(MINUTES_PER_DAY)
+    return (local - timezone * 60) % MINUTES_PER_DAY, timezone
+
+
+@dataclass
+class Stats:
+    due: dict[int, int] = field(default_factory=dict) # chat_id -> epoch minute the delivery is due
+    handler_latency: dict[str, list[float]] = field(default_factory=dict)
+    timeouts: int = 0
+
+    def record(self, kind: str, latency: float | None):
+        if latency is None:
+            self.timeouts += 1
+        else:
+            self.handler_latency.setdefault(kind, []).append(latency)
+
+
+class Simulation:
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(SEED)
+        self.api = FakeBotAPI()
+        self.stats = Stats()
+        self.data_dir = pathlib.Path(tempfile.mkdtemp(prefix='loadsim_'))
+        self.stop = threading.Event()
+
+
+    def prepare(self):
+        (self.data_dir / 'token').write_text('1:loadsim', encoding='utf-8')
+        for path in (pathlib.Path(__file__).resolve().parent.parent / PACKAGE / 'config').glob('verbs_*.txt'):
+            shutil.copy(path, self.data_dir)
+
+        SubInfo = _module('sub_storage').SubInfo
+        args = self.args
+        # Real minutes of the run, the first one is the next full minute
+        self.first_minute = int(time.time() // 60) + 1
+        sim_start = PEAK_MINUTE - args.speed * args.minutes // 2
+        rows = []
+        while len(rows) < args.subscribers:
+            utc_minute, timezone = sample_slot(self.rng)
+            offset = (utc_minute - sim_start) % MINUTES_PER_DAY
+            if offset >= args.speed * args.minutes:
+                continue
+            due = self.first_minute + offset // args.speed
+            chat_id = SUBSCRIBER_CHATS + len(rows)
+            local = (due + timezone * 60) % MINUTES_PER_DAY
+            rows.append((chat_id, SubInfo(self.rng.choice(['numbers', 'verbs']), self.rng.choice(['DE', 'EN']),
+                                          local // 60, local % 60, timezone)))
+            self.stats.due[chat_id] = due
+        _fill_storage(args.storage, self.data_dir, rows)
+
+
+    def exchange(self, chat_id: int, update: dict, kind: str) -> bool:
+        responses = self.api.responses(chat_id)
+        while not responses.empty():
+            responses.get_nowait()
+        sent = self.api.push(update)
+        try:
+            while True:
+                at, method = responses.get(timeout=RESPONSE_TIMEOUT)
+                if method in ('sendMessage', 'editMessageText'):
+                    self.stats.record(kind, at - sent)
+                    return True
+        except queue.Empty:
+            self.stats.record(kind, None)
+            return False
+
+
+    def session(self, chat_id: int):
+        # A new user subscribing (outside of the simulated window) and listing the subscriptions
+        steps = [
+            (message_update(chat_id, '/subscribe'), 'subscribe.start'),
+            (callback_update(chat_id, 'task:numbers'), 'subscribe.task'),
+            (callback_update(chat_id, 'lang:DE'), 'subscribe.lang'),
+            (message_update(chat_id, '03:30+0'), 'subscribe.time'),
+            (message_update(chat_id, '/list'), 'list'),
+        ]
+        for update, kind in steps:
+            if self.stop.is_set() or not self.exchange(chat_id, update, kind):
+                return
+
+
+    def answer(self, chat_id: int):
+        time.sleep(self.rng.uniform(0, self.args.think_time))
+        numbers = ' '.join(str(self.rng.randrange(1, 100)) for _ in range(9))
+        self.exchange(chat_id, message_update(chat_id, numbers), 'answer')
+
+
+    def drive(self):
+        args = self.args
+        end = (self.first_minute + args.minutes) * 60 + args.grace
+        next_chat = 1
+        answered = set()
+        with ThreadPoolExecutor(max_workers=args.users) as users:
+            last = time.time()
+            while time.time() < end and not self.stop.is_set():
+                time.sleep(0.1)
+                now = time.time()
+                for _ in range(int(now * args.sessions_per_second) - int(last * args.sessions_per_second)):
+                    users.submit(self.session, next_chat)
+                    next_chat += 1
+                last = now
+                for chat_id in list(self.api.voices):
+                    if chat_id >= SUBSCRIBER_CHATS and chat_id not in answered:
+                        answered.add(chat_id)
+                        if self.rng.random() < args.answer_ratio:
+                            users.submit(self.answer, chat_id)
+                if len(self.api.voices) >= len(self.stats.due) and now > self.first_minute * 60 + args.minutes * 60:
+                    break
+            self.stop.set()
+        os.kill(os.getpid(), signal.SIGINT)
+
+
+    def report(self) -> dict:
+        lags: dict[int, list[float]] = {}
+        # monotonic times of the fake API -> wall clock
+        offset = time.time() - time.monotonic()
+        for chat_id, due in self.stats.due.items():
+            lags.setdefault(due, [])
+            if chat_id in self.api.voices:
+                lags[due].append(self.api.voices[chat_id] + offset - due * 60)
+        deliveries = {}
+        for due, values in sorted(lags.items()):
+            label = time.strftime('%H:%M', time.gmtime(due * 60))
+            scheduled = sum(1 for minute in self.stats.due.values() if minute == due)
+            deliveries[label] = {'scheduled': scheduled, 'delivered': len(values), **{f'lag_{k}': v for k, v in summary(values).items() if k != 'count'}}
+
+        return {
+            'subscribers': len(self.stats.due),
+            'minutes': self.args.minutes,
+            'speed': self.args.speed,
+            'settings': {'storage': self.args.storage, 'shared_exercises': self.args.shared_exercises,
+                         'shards': self.args.shards, 'concurrent_updates': self.args.concurrent_updates},
+            'deliveries': deliveries,
+            'undelivered': len(self.stats.due) - sum(1 for chat_id in self.stats.due if chat_id in self.api.voices),
+            'handlers': {kind: summary(values) for kind, values in sorted(self.stats.handler_latency.items())},
+            'handler_timeouts': self.stats.timeouts,
+            'api_calls': dict(sorted(self.api.calls.items())),
+            # Whole process: the bot, the fake API and the simulated users
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'peak_rss_largest_child_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1), # shards, ffmpeg
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load simulation of the bot against a fake Bot API')
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--minutes', type=int, default=3, help='real minutes of deliveries to simulate')
+    parser.add_argument('--speed', type=int, default=60, help='minutes of the day replayed per real minute')
+    parser.add_argument('--sessions-per-second', type=float, default=2, help='new users going through /subscribe and /list')
+    parser.add_argument('--answer-ratio', type=float, default=0.3, help='share of subscribers answering their exercise')
+    parser.add_argument('--think-time', type=float, default=5, help='seconds a subscriber takes to answer, at most')
+    parser.add_argument('--users', type=int, default=64, help='simulated users active at the same time')
+    parser.add_argument('--grace', type=int, default=60, help='seconds to wait for late deliveries after the last minute')
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--shared-exercises', choices=['off', 'day', 'slot'], default='off')
+    parser.add_argument('--shards', type=int, default=0)
+    parser.add_argument('--concurrent-updates', type=int, default=32)
+    parser.add_argument('-o', '--output', type=pathlib.Path, help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if shutil.which('ffmpeg') is None:
+        sys.exit('ffmpeg is required to render the voice tracks')
+
+    simulation = Simulation(args)
+    simulation.prepare()
+
+    # Warmup workers are forked and keep the fake engine, shard workers then find every clip in the cache
+    _module('audio')._synthesize = _fake_tts
+    _module('warmup').warmup(simulation.data_dir)
+
+    Settings = _module('settings').Settings
+    bot = _module('bot').Bot(str(simulation.data_dir), Settings(
+        storage=args.storage,
+        shared_exercises=args.shared_exercises,
+        shards=args.shards,
+        concurrent_updates=args.concurrent_updates,
+        api_url=simulation.api.url,
+    ))
+    driver = threading.Thread(target=simulation.drive, daemon=True)
+    driver.start()
+    bot.run()
+    simulation.stop.set()
+
+    report = json.dumps(simulation.report(), indent=2)
+    print(report)
+    if args.output:
+        args.output.write_text(report + '\n', encoding='utf-8')
+    simulation.api.close()
+    shutil.rmtree(simulation.data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,55 @@
+import time
 import logging
+import pathlib
+import argparse
 
 from platformdirs import user_data_dir
 APP_NAME = 'daily-language-bot'
 
-from .bot import Bot
+from .settings import Settings, STORAGE_NAMES, SHARED_MODES
+from .startup import StartupTimer
 
 logger = logging.getLogger(__name__)
 
 
 def main():
+    started = time.perf_counter()
+    parser = argparse.ArgumentParser(prog='daily-language-bot-app')
+    parser.add_argument('command', nargs='?', choices=['run', 'warmup'], default='run',
+                        help='run the bot (default) or pre-render the audio catalogue')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='warmup worker processes (default: number of cores)')
+    parser.add_argument('--storage', choices=STORAGE_NAMES, default=Settings.storage,
+                        help='subscriptions storage backend (sqlite migrates an existing subs.json on first start)')
+    parser.add_argument('--shared-exercises', choices=SHARED_MODES, default=Settings.shared_exercises,
+                        help='render one exercise per task and language for everyone, once a day or once per delivery minute')
+    parser.add_argument('--shards', type=int, default=Settings.shards,
+                        help='deliver subscriptions from this many worker processes, split by chat (default: from the main process)')
+    parser.add_argument('--concurrent-updates', type=int, default=Settings.concurrent_updates,
+                        help='updates of different chats processed in parallel, updates of one chat stay in order (1: sequential)')
+    parser.add_argument('--webhook-url', default=Settings.webhook_url,
+                        help='receive updates through a webhook at this public URL instead of long polling')
+    parser.add_argument('--webhook-listen', default=Settings.webhook_listen,
+                        help='address the webhook listener binds to')
+    parser.add_argument('--webhook-port', type=int, default=Settings.webhook_port,
+                        help='port the webhook listener binds to')
+    parser.add_argument('--webhook-path', default=Settings.webhook_path,
+                        help='URL path of the webhook listener')
+    parser.add_argument('--webhook-max-connections', type=int, choices=range(1, 101), metavar='1-100',
+                        default=Settings.webhook_max_connections,
+                        help='maximum simultaneous connections Telegram opens to the webhook')
+    parser.add_argument('--api-url', default=Settings.api_url,
+                        help='Bot API server to use instead of api.telegram.org')
+    parser.add_argument('--metrics-port', type=int, default=Settings.metrics_port,
+                        help='serve Prometheus metrics at http://<metrics-listen>:<port>/metrics, shard N on port + 1 + N')
+    parser.add_argument('--metrics-listen', default=Settings.metrics_listen,
+                        help='address the metrics listener binds to')
+    parser.add_argument('--profile-threshold', type=float, default=Settings.profile_threshold, metavar='SECONDS',
+                        help='report conversation steps and delivery jobs slower than this to <data dir>/profiles')
+    parser.add_argument('--profile-sample-rate', type=float, default=Settings.profile_sample_rate,
+                        help='share of invocations run under cProfile while profiling (default: %(default)s)')
+    args = parser.parse_args()
+
     LOG_FORMAT = (
         "%(asctime)s | "
         "%(levelname)-8s | "
@@ -25,8 +66,34 @@ def main():
     logging.getLogger("httpcore").setLevel(logging.WARNING)
     logging.getLogger("telegram").setLevel(logging.INFO)
 
+    if args.command == 'warmup':
+        from .warmup import warmup
+        logger.info("Warming up audio cache")
+        warmup(pathlib.Path(user_data_dir(APP_NAME)), args.jobs)
+        return
+
     logger.info("Starting German Number Telegram Bot")
-    bot = Bot(user_data_dir(APP_NAME))
+    timer = StartupTimer(started)
+    # The bot stack is imported after the arguments are checked, and timed as part of the startup
+    from .bot import Bot
+    timer.mark('imports')
+    settings = Settings(
+        storage=args.storage,
+        shared_exercises=args.shared_exercises,
+        shards=max(0, args.shards),
+        concurrent_updates=max(1, args.concurrent_updates),
+        webhook_url=args.webhook_url,
+        webhook_listen=args.webhook_listen,
+        webhook_port=args.webhook_port,
+        webhook_path=args.webhook_path,
+        webhook_max_connections=args.webhook_max_connections,
+        api_url=args.api_url,
+        metrics_port=args.metrics_port,
+        metrics_listen=args.metrics_listen,
+        profile_threshold=args.profile_threshold,
+        profile_sample_rate=min(1.0, max(0.0, args.profile_sample_rate)),
+    )
+    bot = Bot(user_data_dir(APP_NAME), settings, timer)
     bot.run()
 
 
@@ -1,50 +1,229 @@
 import os
+import asyncio
+import struct
+import pathlib
 import subprocess
 import tempfile
 import logging
 
-from gtts import gTTS
+from .clip_cache import ClipCache, get_clip_cache
+from .encoder import get_encoder
+from .metrics import TTS_SECONDS, PROBE_SECONDS
+from .ogg import opus_duration
 
 
 logger = logging.getLogger(__name__)
 
+# Upper bound for clips being synthesized at the same time (TTS requests), encoding is bounded by the encoder pool
+MAX_CONCURRENT_SYNTHESIS = 8
 
-def get_duration(path: str) -> int:
-    res = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', path],
-        capture_output=True,
-        text=True
-    )
-    return int(float(res.stdout.strip()))
-
-
-def generate_voice_track(words: list[str], audio_dir: str, out_name: str, lang: str) -> str:
-    out_path = os.path.join(audio_dir, out_name)
-    if not os.path.exists(audio_dir):
-        os.makedirs(audio_dir)
-
-    mp3_path = ''
-    with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as tmp:
-        mp3_path = tmp.name
-        tts = gTTS(text='. '.join(words), lang=lang.lower(), slow=True)
-        tts.save(mp3_path)
-
-    # 5) Convert MP3 → Telegram voice (OGG / Opus)
-    voice_ogg = os.path.join(audio_dir, out_path)
-    logger.info(f'Converting to voice track into {voice_ogg}')
-    subprocess.run([
-            'ffmpeg',
-            '-y',
-            # '-i', concatenated_mp3,
-            '-i', mp3_path,
-            '-c:a', 'libopus',
-            '-ac', '1',
-            '-ar', '24000',
-            '-application', 'voip',
-            voice_ogg,
-        ],
-        check=True,
-        stdout=subprocess.DEVNULL,
+TTS_ENGINE = 'gtts'
+TTS_SPEED = 'slow'
+
+# Silence put between the words of a track
+PAUSE_SECONDS = 0.7
+
+_synthesis_slots: asyncio.Semaphore | None = None
+_pending_clips: dict[str, asyncio.Future] = {}
+
+
+def _slots() -> asyncio.Semaphore:
+    global _synthesis_slots
+    if _synthesis_slots is None:
+        _synthesis_slots = asyncio.Semaphore(MAX_CONCURRENT_SYNTHESIS)
+    return _synthesis_slots
+
+
+async def _run(cmd: list[str]) -> bytes:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=subprocess.PIPE,
         stderr=subprocess.DEVNULL,
     )
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return out
+
+
+async def get_duration(path: str, content: bytes = None) -> float:
+    """
+    Duration of an OGG/Opus track in seconds.
+    Read in-process from the Ogg pages, ffprobe is used only for streams the reader does not understand.
+    :param content: Track content if it is already in memory
+    """
+    try:
+        with PROBE_SECONDS.time('ogg'):
+            return opus_duration(content if content is not None else path)
+    except (ValueError, OSError, struct.error) as e:
+        logger.warning(f'Falling back to ffprobe for {path}: {e}')
+    with PROBE_SECONDS.time('ffprobe'):
+        out = await _run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', path])
+    return float(out.decode().strip())
+
+
+def _synthesize(text: str, lang: str, mp3_path: str):
+    # Imported on first use: most startups and deliveries only read cached clips
+    from gtts import gTTS
+    tts = gTTS(text=text, lang=lang.lower(), slow=TTS_SPEED == 'slow')
+    tts.save(mp3_path)
+
+
+async def synthesize(text: str, lang: str, mp3_path: str):
+    # gTTS is a blocking HTTP client, keep it off the event loop
+    async with _slots():
+        with TTS_SECONDS.time(lang.lower()):
+            await asyncio.to_thread(_synthesize, text, lang, mp3_path)
+
+
+OPUS_ARGS = [
+    '-c:a', 'libopus',
+    '-ac', '1',
+    '-ar', '24000',
+    '-application', 'voip',
+]
+
+
+def _encode_voice_cmd(src_path: str, out_path: str) -> list[str]:
+    # Convert MP3 → Telegram voice (OGG / Opus)
+    return ['ffmpeg', '-y', '-i', src_path, *OPUS_ARGS, '-f', 'ogg', out_path]
+
+
+def _encode_pause_cmd(out_path: str) -> list[str]:
+    return ['ffmpeg', '-y', '-f', 'lavfi', '-i', 'anullsrc=r=24000:cl=mono', '-t', str(PAUSE_SECONDS), *OPUS_ARGS, '-f', 'ogg', out_path]
+
+
+async def encode_voice(src_path: str, out_path: str):
+    await get_encoder().run(_encode_voice_cmd(src_path, out_path))
+
+
+async def encode_pause(out_path: str):
+    await get_encoder().run(_encode_pause_cmd(out_path))
+
+
+async def concat_clips(clip_paths: list[pathlib.Path], out_path: str):
+    # All clips share the same encoding parameters, so the streams are copied without re-encoding.
+    # Bitexact muxing keeps the output byte-identical for identical inputs (see file_id_cache).
+    fd, list_path = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write('ffconcat version 1.0\n')
+        for path in clip_paths:
+            escaped = str(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    try:
+        await get_encoder().run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', '-fflags', '+bitexact', '-f', 'ogg', out_path])
+    finally:
+        os.remove(list_path)
+
+
+def clip_key(text: str, lang: str) -> str:
+    return ClipCache.key(lang, text, TTS_SPEED, TTS_ENGINE)
+
+
+def pause_key() -> str:
+    return ClipCache.key('', '', str(PAUSE_SECONDS), 'silence')
+
+
+async def _render_clip(key: str, text: str, lang: str, cache: ClipCache) -> pathlib.Path:
+    logger.info(f'Synthesizing clip "{text}" ({lang})')
+    fd, mp3_path = tempfile.mkstemp(suffix='.mp3')
+    os.close(fd)
+    try:
+        await synthesize(text, lang, mp3_path)
+        with cache.writer(key) as clip_path:
+            await encode_voice(mp3_path, clip_path)
+    finally:
+        os.remove(mp3_path)
+    return cache.path(key)
+
+
+async def _render_pause(key: str, cache: ClipCache) -> pathlib.Path:
+    with cache.writer(key) as clip_path:
+        await encode_pause(clip_path)
+    return cache.path(key)
+
+
+async def _cached(key: str, cache: ClipCache, render) -> pathlib.Path:
+    path = cache.lookup(key)
+    if path is not None:
+        return path
+    # Concurrent requests for the same clip share a single render
+    pending = _pending_clips.get(key)
+    if pending is None:
+        pending = asyncio.ensure_future(render())
+        _pending_clips[key] = pending
+        pending.add_done_callback(lambda _: _pending_clips.pop(key, None))
+    return await asyncio.shield(pending)
+
+
+async def get_clip(text: str, lang: str, cache: ClipCache) -> pathlib.Path:
+    key = clip_key(text, lang)
+    return await _cached(key, cache, lambda: _render_clip(key, text, lang, cache))
+
+
+async def get_pause(cache: ClipCache) -> pathlib.Path:
+    key = pause_key()
+    return await _cached(key, cache, lambda: _render_pause(key, cache))
+
+
+def render_clip_sync(text: str, lang: str, cache: ClipCache) -> pathlib.Path:
+    """
+    Blocking counterpart of get_clip for use outside of the event loop (e.g. warmup workers).
+    """
+    key = clip_key(text, lang)
+    path = cache.lookup(key)
+    if path is not None:
+        return path
+    fd, mp3_path = tempfile.mkstemp(suffix='.mp3')
+    os.close(fd)
+    try:
+        _synthesize(text, lang, mp3_path)
+        with cache.writer(key) as clip_path:
+            subprocess.run(_encode_voice_cmd(mp3_path, clip_path), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    finally:
+        os.remove(mp3_path)
+    return cache.path(key)
+
+
+def render_pause_sync(cache: ClipCache) -> pathlib.Path:
+    key = pause_key()
+    path = cache.lookup(key)
+    if path is not None:
+        return path
+    with cache.writer(key) as clip_path:
+        subprocess.run(_encode_pause_cmd(clip_path), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cache.path(key)
+
+
+async def prefetch_clips(words: list[str], audio_dir: str, lang: str):
+    """
+    Make sure clips for all words are in the cache, rendering the missing ones concurrently.
+    """
+    cache = get_clip_cache(pathlib.Path(audio_dir))
+    await asyncio.gather(get_pause(cache), *(get_clip(word, lang, cache) for word in words))
+
+
+async def generate_voice_track(words: list[str], audio_dir: str, lang: str) -> str:
+    """
+    Assemble a Telegram voice track from cached per-word clips, synthesizing only the missing ones.
+    Every call writes its own file in audio_dir, the caller is responsible for removing it.
+    :return: Path to the OGG/Opus track
+    """
+    cache = get_clip_cache(pathlib.Path(audio_dir))
+
+    clips = await asyncio.gather(*(get_clip(word, lang, cache) for word in words))
+    pause = await get_pause(cache)
+    parts = [pause]
+    for clip in clips:
+        parts.extend((clip, pause))
+
+    fd, voice_ogg = tempfile.mkstemp(prefix='voice_', suffix='.ogg', dir=audio_dir)
+    os.close(fd)
+    try:
+        logger.info(f'Assembling voice track into {voice_ogg}')
+        await concat_clips(parts, voice_ogg)
+    except BaseException:
+        os.remove(voice_ogg)
+        raise
 
     return voice_ogg
@@ -1,5 +1,6 @@
 import logging
 import pathlib
+import secrets
 from types import SimpleNamespace
 
 from telegram import Update, BotCommand, MenuButtonCommands
@@ -10,12 +11,23 @@ from telegram.ext import (
     filters, CallbackContext,
 )
 
+from .settings import Settings
+from .startup import StartupTimer
+from .rate_limiter import TelegramRateLimiter
+from .update_processor import ChatOrderedUpdateProcessor
+from .sharding import ShardPool
+from .encoder import get_encoder
+from .metrics import MetricsServer, SCHEDULED, ACTIVE_EXERCISES, CONVERSATIONS
+from .profiling import enable_profiling
 from .sub_manager import SubManager, SubInfo
+from .sub_storage import open_storage
 from .checks import dispatch_check
+from .exercise_store import get_exercise_store, FLUSH_INTERVAL, SWEEP_INTERVAL
 from .jobs import *
 from .subscribe_conversation import SubConversation
 from .unsubscibe_conversation import UnsubConversation
 from .edit_conversation import EditConversation
+from .conversation import reap_user_data, REAP_INTERVAL
 
 logger = logging.getLogger(__name__)
 
@@ -30,31 +42,135 @@ class Bot:
     }
 
 
-    def __init__(self, data_dir: str):
+    def __init__(self, data_dir: str, settings: Settings = None, timer: StartupTimer = None):
+        """
+        :param timer: startup phases measured so far, e.g. imports
+        """
+        self.settings = settings or Settings()
+        self.timer = timer or StartupTimer()
         with open(pathlib.Path(data_dir) / 'token', 'r', encoding='utf-8') as f:
-            self.app = ApplicationBuilder().token(f.read().strip()).post_init(self.__post_init).build()
+            builder = (ApplicationBuilder()
+                       .token(f.read().strip())
+                       .rate_limiter(TelegramRateLimiter())
+                       .post_init(self.__post_init)
+                       .post_shutdown(self.__post_shutdown))
+        if self.settings.concurrent_updates > 1:
+            builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(self.settings.concurrent_updates))
+        if self.settings.api_url:
+            api_url = self.settings.api_url.rstrip('/')
+            builder = builder.base_url(f'{api_url}/bot').base_file_url(f'{api_url}/file/bot')
+        self.app = builder.build()
         self.data_dir = data_dir
-        self.sub_manager = SubManager(pathlib.Path(data_dir), self.app)
+        if self.settings.profile_threshold is not None:
+            enable_profiling(pathlib.Path(data_dir), self.settings.profile_threshold, self.settings.profile_sample_rate)
+        self.timer.mark('application')
+        storage = open_storage(self.settings.storage, pathlib.Path(data_dir))
+        self.exercises = get_exercise_store(pathlib.Path(data_dir))
+        self.timer.mark('storage')
+        self.shards = ShardPool(pathlib.Path(data_dir), self.settings, self.exercises) if self.settings.shards else None
+        self.sub_manager = SubManager(pathlib.Path(data_dir), self.app, storage, self.settings.shared_exercises, self.shards)
+        self.timer.mark('subscriptions')
+        self.app.job_queue.run_repeating(self.exercises.flush_job, interval=FLUSH_INTERVAL)
+        self.app.job_queue.run_repeating(self.exercises.sweep_job, interval=SWEEP_INTERVAL)
+        self.app.job_queue.run_repeating(self._reap_job, interval=REAP_INTERVAL, first=REAP_INTERVAL)
         self._init_cmds()
+        self._init_metrics()
+        self.timer.mark('handlers')
 
 
     async def __post_init(self, app):
         await app.bot.set_my_commands([BotCommand(cmd, desc) for cmd, desc in self.__CMDS.items()])
         await app.bot.set_chat_menu_button(menu_button=MenuButtonCommands())
+        self.timer.mark('bot api')
+        if self.metrics is not None:
+            await self.metrics.start()
+        if self.shards is not None:
+            self.shards.start(app)
+            self.timer.mark('shards')
+        self.timer.report()
+
+
+    async def __post_shutdown(self, app):
+        if self.shards is not None:
+            await self.shards.stop()
+        await get_encoder().close()
+        if self.metrics is not None:
+            await self.metrics.stop()
+        self.exercises.flush()
 
 
     def run(self):
-        logger.info(f'Starting bot')
-        self.app.run_polling()
+        if self.settings.webhook_url:
+            self._run_webhook()
+        else:
+            logger.info(f'Starting bot (polling)')
+            self.app.run_polling()
+
+
+    def _webhook_secret(self) -> str:
+        """
+        Secret Telegram sends with every update in X-Telegram-Bot-Api-Secret-Token.
+        Kept in data_dir/webhook_secret so a reverse proxy can check it too, generated on first use.
+        """
+        path = pathlib.Path(self.data_dir) / 'webhook_secret'
+        if not path.exists():
+            tmp = path.with_suffix('.tmp')
+            tmp.write_text(secrets.token_urlsafe(32), encoding='utf-8')
+            tmp.chmod(0o600)
+            tmp.replace(path)
+        return path.read_text(encoding='utf-8').strip()
+
+
+    def _run_webhook(self):
+        settings = self.settings
+        path = settings.webhook_path.strip('/')
+        webhook_url = settings.webhook_url.rstrip('/')
+        if not webhook_url.endswith(f'/{path}'):
+            webhook_url = f'{webhook_url}/{path}'
+        logger.info(f'Starting bot (webhook {webhook_url}, listening on {settings.webhook_listen}:{settings.webhook_port}/{path})')
+        # Requests without the secret token are rejected by the listener with 403
+        self.app.run_webhook(
+            listen=settings.webhook_listen,
+            port=settings.webhook_port,
+            url_path=path,
+            webhook_url=webhook_url,
+            secret_token=self._webhook_secret(),
+            max_connections=settings.webhook_max_connections,
+        )
 
 
     def _init_cmds(self):
-        self.app.add_handler(SubConversation(self.sub_manager))
-        self.app.add_handler(UnsubConversation(self.sub_manager))
-        self.app.add_handler(EditConversation(self.sub_manager))
+        self.conversations = [
+            SubConversation(self.sub_manager),
+            UnsubConversation(self.sub_manager),
+            EditConversation(self.sub_manager),
+        ]
+        for conversation in self.conversations:
+            self.app.add_handler(conversation)
         self.app.add_handler(CommandHandler('list', self._list))
         self.app.add_handler(CommandHandler('test', self._test))
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, dispatch_check))
+        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self._check))
+
+
+    async def _reap_job(self, context: CallbackContext):
+        dropped = reap_user_data(self.app, self.conversations)
+        if dropped:
+            logger.info(f'Dropped conversation data of {dropped} idle users')
+
+
+    def _init_metrics(self):
+        settings = self.settings
+        self.metrics = MetricsServer(settings.metrics_listen, settings.metrics_port) if settings.metrics_port else None
+        SCHEDULED.set_function(lambda: len(self.sub_manager.scheduler))
+        ACTIVE_EXERCISES.set_function(lambda: len(self.exercises))
+        CONVERSATIONS.set_function(lambda: {
+            (type(conversation).__name__, step): count
+            for conversation in self.conversations for step, count in conversation.active_steps().items()
+        })
+
+
+    async def _check(self, update: Update, context: CallbackContext):
+        await dispatch_check(update, context, self.exercises, pathlib.Path(self.data_dir))
 
 
     async def _list(self, update: Update, context: CallbackContext):
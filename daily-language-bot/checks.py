@@ -1,48 +1,45 @@
+import re
 import logging
+import pathlib
 
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 from telegram import Update
 
 from .jobs import DAILY_NUMBERS_BATCH_SIZE
-from .numbers_de import NUMBERS
+from .numbers_de import NUMBERS, LEXICONS
+from .exercise_store import Exercise, ExerciseStore
+from .verbs import VerbForms, get_verb_catalogue, normalize_form, verbs_path
 
 
 logger = logging.getLogger(__name__)
 
 
-async def dispatch_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def dispatch_check(update: Update, context: ContextTypes.DEFAULT_TYPE, exercises: ExerciseStore, data_dir: pathlib.Path):
     chat_id = update.message.chat_id
     logger.debug(f'Received answer from {chat_id}: {update.message.text}')
-    expected = context.bot_data.get(chat_id)
+    expected = exercises.get(chat_id)
     if not expected:
         logger.warning(f'No active exercise for chat {chat_id}')
         await update.message.reply_text('No active exercise for this chat')
         return
 
-    if expected['task'] == 'numbers':
+    if expected.task == 'numbers':
         await check_numbers_task(update, chat_id, expected)
+    elif expected.task == 'verbs':
+        await check_verbs_task(update, chat_id, expected, data_dir)
     else:
         await update.message.reply_text('Unsupported task')
 
 
 def parse_numbers_answer(text: str, language: str) -> list[str]:
-    if language == 'de':
-        # all answers are one-word
-        return text.split()
+    return LEXICONS[language.upper()].split_answers(text)
 
-    answer_parts = text.split('\n')
-    res = []
-    res.extend(answer_parts[:3]) # numbers translated
 
-    # Rest is split by any whitespace and linearized
-    res.extend([ans for sub_answers in answer_parts[3:] for ans in sub_answers.split()])
-    return res
-
-
-async def check_numbers_task(update: Update, chat_id, expected: dict):
-    language = expected['language']
-    answers = parse_numbers_answer(update.message.text.lower(), language)
+async def check_numbers_task(update: Update, chat_id, expected: Exercise):
+    language = expected.language
+    lexicon = LEXICONS[language]
+    answers = parse_numbers_answer(update.message.text, language)
     if len(answers) < DAILY_NUMBERS_BATCH_SIZE * 3:
         logger.info(f'Invalid answer length ({len(answers)}) from {chat_id}')
         await update.message.reply_text(f'❌ Please send {DAILY_NUMBERS_BATCH_SIZE * 3} answers.')
@@ -53,8 +50,8 @@ async def check_numbers_task(update: Update, chat_id, expected: dict):
 
     # First 10 – Numbers to text
     score_message += '🔢 *Numbers*\n'
-    for ans, num in zip(answers[:DAILY_NUMBERS_BATCH_SIZE], expected['numerical']):
-        correct: bool = ans == NUMBERS[language][num]
+    for ans, num in zip(answers[:DAILY_NUMBERS_BATCH_SIZE], expected.numerical):
+        correct: bool = lexicon.value(ans) == num
         score_message += '✅' if correct else '❌'
         score_message += f' {num} - {NUMBERS[language][num]}\n'
         if correct:
@@ -63,7 +60,7 @@ async def check_numbers_task(update: Update, chat_id, expected: dict):
 
     # Second 10 – Text to numbers
     score_message += '📝 *Text Numbers*\n'
-    for ans, num in zip(answers[DAILY_NUMBERS_BATCH_SIZE:DAILY_NUMBERS_BATCH_SIZE * 2], expected['text']):
+    for ans, num in zip(answers[DAILY_NUMBERS_BATCH_SIZE:DAILY_NUMBERS_BATCH_SIZE * 2], expected.text):
         correct: bool = ans.isdigit() and int(ans) == num
         score_message += '✅' if correct else '❌'
         score_message += f' {NUMBERS[language][num]} - {num}\n'
@@ -73,7 +70,7 @@ async def check_numbers_task(update: Update, chat_id, expected: dict):
 
     # Third 10 – Numbers from audio
     score_message += '🔊 *Audio Numbers*\n'
-    for ans, num in zip(answers[DAILY_NUMBERS_BATCH_SIZE * 2:], expected['audio']):
+    for ans, num in zip(answers[DAILY_NUMBERS_BATCH_SIZE * 2:], expected.audio):
         correct: bool = ans.isdigit() and int(ans) == num
         score_message += '✅' if correct else '❌'
         score_message += f' {NUMBERS[language][num]} - {num}\n'
@@ -84,4 +81,64 @@ async def check_numbers_task(update: Update, chat_id, expected: dict):
     score_message += f'Total score : {score}/{DAILY_NUMBERS_BATCH_SIZE * 3}'
 
     logger.info(f'User {chat_id} scored {score}/{DAILY_NUMBERS_BATCH_SIZE * 3}')
-    await update.message.reply_text(score_message, parse_mode=ParseMode.MARKDOWN)
\ No newline at end of file
+    await update.message.reply_text(score_message, parse_mode=ParseMode.MARKDOWN)
+
+
+def parse_verbs_answer(text: str, infinitive: str = '') -> list[str]:
+    """
+    Split a verbs answer into past, participle and translation parts, without a leading infinitive.
+    :param infinitive: normalized infinitive of the exercise, dropped if the answer starts with it
+    """
+    # 'ging, gegangen', 'gehen - ging - gegangen', one form per line...
+    answers = [part.strip() for part in re.split(r'[\n;,]|\s[-–]\s', text) if part.strip()]
+    if len(answers) == 1:
+        # 'ging gegangen' or 'gehen ging gegangen to go': single words, the translation is the rest
+        answers = answers[0].split()
+        if len(answers) > 2 and normalize_form(answers[0]) == infinitive:
+            answers = answers[1:]
+        return answers[:2] + [' '.join(answers[2:])] if len(answers) > 2 else answers
+    # Leading infinitive is optional, 'put, put' alone are the two forms
+    if len(answers) > 2 and normalize_form(answers[0]) == infinitive:
+        answers = answers[1:]
+    return answers
+
+
+def _translation_correct(answer_parts: list[str], accepted: frozenset[str]) -> bool:
+    # 'to command, to order' or 'to shout / to yell': one known meaning is enough
+    parts = [normalize_form(part) for answer in answer_parts for part in re.split(r'/', answer)]
+    return any(part in accepted for part in parts if part)
+
+
+async def check_verbs_task(update: Update, chat_id, expected: Exercise, data_dir: pathlib.Path):
+    infinitive, past, participle, translation = (list(expected.values) + [''] * 4)[:4]
+    path = verbs_path(data_dir, expected.language)
+    forms = get_verb_catalogue(path).forms(infinitive) if path.exists() else None
+    if forms is None:
+        # The verb was removed from the file since the exercise was sent
+        forms = VerbForms.from_values(expected.values)
+
+    answers = parse_verbs_answer(update.message.text, forms.infinitive)
+    if len(answers) < 2:
+        logger.info(f'Invalid verbs answer from {chat_id}')
+        await update.message.reply_text('❌ Please send the past and participle forms, e.g. "ging, gegangen".')
+        return
+
+    # Anything after the two forms is the translation, which may list several meanings
+    checks = [
+        ('Past', normalize_form(answers[0]) in forms.past, past),
+        ('Participle', normalize_form(answers[1]) in forms.participle, participle),
+    ]
+    if len(answers) > 2:
+        checks.append(('Translation', _translation_correct(answers[2:], forms.translation), translation))
+
+    score = 0
+    score_message = f'📖 *Verbs*: {infinitive}\n'
+    for name, correct, correct_form in checks:
+        score_message += '✅' if correct else '❌'
+        score_message += f' {name} - {correct_form}\n'
+        if correct:
+            score += 1
+    score_message += f'\nTotal score : {score}/{len(checks)}'
+
+    logger.info(f'User {chat_id} scored {score}/{len(checks)}')
+    await update.message.reply_text(score_message, parse_mode=ParseMode.MARKDOWN)
@@ -0,0 +1,117 @@
+import os
+import hashlib
+import logging
+import pathlib
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import cache
+
+
+logger = logging.getLogger(__name__)
+
+CLIP_SUFFIX = '.ogg'
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ClipCache:
+    """
+    Content-addressed on-disk cache of synthesized clips.
+    Clips are keyed by (language, text, speed, engine) and evicted in LRU order once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir: pathlib.Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, int] = OrderedDict() # key -> size, least recently used first
+        self._size = 0
+        self._scan()
+
+
+    @staticmethod
+    def key(lang: str, text: str, speed: str, engine: str) -> str:
+        return hashlib.sha256('\0'.join((engine, lang.lower(), speed, text)).encode('utf-8')).hexdigest()
+
+
+    def _scan(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        clips = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(CLIP_SUFFIX):
+                stat = entry.stat()
+                clips.append((stat.st_mtime, entry.name[:-len(CLIP_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(clips):
+            self._entries[key] = size
+            self._size += size
+        logger.info(f'Clip cache at {self.cache_dir}: {len(self._entries)} clips, {self._size} bytes')
+
+
+    def path(self, key: str) -> pathlib.Path:
+        return self.cache_dir / f'{key}{CLIP_SUFFIX}'
+
+
+    def lookup(self, key: str) -> pathlib.Path | None:
+        path = self.path(key)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            try:
+                os.utime(path) # keep recency across restarts
+                return path
+            except FileNotFoundError:
+                self._size -= self._entries.pop(key)
+                return None
+
+        # Clip may have been rendered by another process (e.g. warmup)
+        try:
+            self._register(key, path.stat().st_size)
+        except FileNotFoundError:
+            return None
+        return path
+
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries or self.path(key).exists()
+
+
+    @contextmanager
+    def writer(self, key: str):
+        """
+        Atomically add a clip: yields a temporary path in the cache directory to be filled by the caller.
+        The clip becomes visible only when the block exits without an error.
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', suffix=CLIP_SUFFIX, dir=self.cache_dir)
+        os.close(fd)
+        try:
+            yield tmp_path
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._register(key, self.path(key).stat().st_size)
+
+
+    def _register(self, key: str, size: int):
+        if key in self._entries:
+            self._size -= self._entries[key]
+        self._entries[key] = size
+        self._entries.move_to_end(key)
+        self._size += size
+        self._evict()
+
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            logger.debug(f'Evicting clip {key}')
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+
+@cache
+def get_clip_cache(audio_dir: pathlib.Path) -> ClipCache:
+    return ClipCache(audio_dir / 'clips')
@@ -1,3 +1,5 @@
+import re
+import time
 import logging
 from functools import wraps
 from enum import Enum
@@ -5,13 +7,23 @@ from enum import Enum
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.constants import ParseMode
 from telegram.ext import (
-    ConversationHandler, CommandHandler, CallbackQueryHandler,
-    CallbackContext, MessageHandler, filters
+    Application, BaseHandler, ConversationHandler, CommandHandler,
+    CallbackContext, MessageHandler, TypeHandler, filters
 )
 
+from .profiling import profiled
+
 
 logger = logging.getLogger(__name__)
 
+CONVERSATION_TIMEOUT = 15 * 60 # seconds of inactivity after which a conversation is abandoned
+MAX_BACK_STEPS = 10 # screens kept for the Back button, a step repeated on invalid input adds one each time
+REAP_INTERVAL = 10 * 60 # seconds between drops of user_data left by abandoned conversations
+
+# Screen restored by the Back button: step number, message text and the keyboard as rows of (text, callback_data)
+CompactKeyboard = tuple[tuple[tuple[str, str], ...], ...]
+BackStep = tuple[int, str, CompactKeyboard | None]
+
 
 class ActionButton:
     BACK = ('⬅️Back', 'action:back')
@@ -31,12 +43,60 @@ def make_choice_keyboard(button_names: list[list[tuple[str, str]]] = None, only_
     return build_inline_keyboard(button_names + choice_kb) if button_names else build_inline_keyboard(choice_kb)
 
 
+def compact_keyboard(markup: InlineKeyboardMarkup | None) -> CompactKeyboard | None:
+    if markup is None:
+        return None
+    return tuple(tuple((button.text, button.callback_data) for button in row) for row in markup.inline_keyboard)
+
+
+def restore_keyboard(keyboard: CompactKeyboard | None) -> InlineKeyboardMarkup | None:
+    return build_inline_keyboard(keyboard) if keyboard is not None else None
+
+
 async def get_query(update: Update):
     query = update.callback_query
     await query.answer()
     return query, query.data.split(':')[1]
 
 
+def callback_prefix(data: str) -> str:
+    """
+    Routing prefix of button callback data in the 'prefix:value' format, the whole data if it has no value.
+    """
+    return data.split(':', 1)[0]
+
+
+class ButtonRouter(BaseHandler[Update, CallbackContext]):
+    """
+    Handles the button presses of a conversation state: the prefix of the callback data is looked up in a table
+    built once per conversation, instead of trying a regex CallbackQueryHandler per step.
+    """
+
+    def __init__(self, routes: dict[str, callable], default: callable = None):
+        """
+        :param routes: step callback per callback data prefix
+        :param default: callback for buttons without a route, e.g. of an outdated keyboard
+        """
+        super().__init__(self.__route)
+        self.routes = routes
+        self.default = default
+
+
+    def check_update(self, update: object):
+        if not isinstance(update, Update) or update.callback_query is None or not isinstance(update.callback_query.data, str):
+            return None
+        return self.routes.get(callback_prefix(update.callback_query.data), self.default)
+
+
+    async def handle_update(self, update: Update, application: Application, check_result, context: CallbackContext):
+        return await check_result(update, context)
+
+
+    async def __route(self, update: Update, context: CallbackContext):
+        callback = self.check_update(update)
+        return await callback(update, context) if callback is not None else None
+
+
 class StepTrigger(Enum):
     MESSAGE = 0,    # Callback is called for message typed in
     BUTTON = 1      # Callback is called for a button pressed
@@ -47,17 +107,22 @@ def conversation_step(step_no: int, trigger: StepTrigger = StepTrigger.MESSAGE,
     Decorator for conversation steps.
     :param step_no: Step number
     :param trigger: What should trigger the step: message or a button
-    :param pattern: If given, trigger the step with this pattern
+    :param pattern: If given, trigger the step with this pattern: '^prefix:' matching callback data 'prefix:value' (or '^prefix' for data without a value)
     :return:
     """
     assert trigger == StepTrigger.MESSAGE and pattern is None or trigger == StepTrigger.BUTTON and pattern is not None
+    assert pattern is None or re.fullmatch(r'\^[\w-]+:?', pattern), f'Steps are routed by callback data prefix, not by {pattern!r}'
     def decorator(func):
-        @wraps(func)
-        async def wrapper(self, update: Update, context: CallbackContext, *args, **kwargs):
+        async def run_step(self, update: Update, context: CallbackContext, *args, **kwargs):
+            # Set before the step runs, so the reaper never drops the data of a step in progress
+            context.user_data['conversation'] = self.name
+            context.user_data['last_step_at'] = time.time()
             res = await func(self, update, context, *args, **kwargs)
             if 'step_cache' not in context.user_data:
                 context.user_data['step_cache'] = []
-            context.user_data['step_cache'].append((step_no, update.effective_message.text, update.effective_message.reply_markup))
+            step_cache: list[BackStep] = context.user_data['step_cache']
+            step_cache.append((step_no, update.effective_message.text, compact_keyboard(update.effective_message.reply_markup)))
+            del step_cache[:-MAX_BACK_STEPS]
             if res is None: # default reaction to void return
             # Regular step finish
                 if step_no == -1:
@@ -77,9 +142,16 @@ def conversation_step(step_no: int, trigger: StepTrigger = StepTrigger.MESSAGE,
                 res = ConversationHandler.END
             return res
 
+        @wraps(func)
+        async def wrapper(self, update: Update, context: CallbackContext, *args, **kwargs):
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            return await profiled(f'{type(self).__name__}.{func.__name__}', step_no, chat_id,
+                                  run_step, self, update, context, *args, **kwargs)
+
         wrapper.step_number = step_no
         wrapper.type = trigger
         wrapper.pattern = pattern
+        wrapper.prefix = pattern.lstrip('^').rstrip(':') if pattern is not None else None
         return wrapper
 
     return decorator
@@ -96,36 +168,48 @@ async def edit_text(update: Update, text: str, markup = None, parse_mode: ParseM
 
 class BaseConversation(ConversationHandler):
 
-    def __init__(self, name: str, timeout: int = None):
+    def __init__(self, name: str, timeout: int = CONVERSATION_TIMEOUT):
+        """
+        :param timeout: seconds of inactivity after which the conversation ends and its user_data is cleared, None to keep it forever
+        """
         super().__init__(entry_points=[CommandHandler(name, self.start)],
-                         states={},
-                         fallbacks=[CallbackQueryHandler(self.cancel), CommandHandler(name, self.restart)],
+                         states={ConversationHandler.TIMEOUT: [TypeHandler(Update, self._timed_out)]},
+                         fallbacks=[ButtonRouter({}, default=self.cancel), CommandHandler(name, self.restart)],
                          conversation_timeout=timeout,
-                         allow_reentry=True)
+                         allow_reentry=True,
+                         name=name)
         self.GO_TO_CONVERSATION_END = -1 # const to be returned to exit ahead of schedule
-        self.__collect_steps_info()
-
-
-    def __collect_steps_info(self):
-        steps = []
-        for attr_name in dir(self):
-            try:
-                attr = getattr(self, attr_name)
-            except AttributeError:
-                continue
-            if callable(attr) and hasattr(attr, 'step_number'):
-                steps.append(attr)
-        for step in steps:
-            handler = None
-            if step.step_number not in self._states:
-                self._states[step.step_number] = [CallbackQueryHandler(self.__process_action, pattern='^action:')]
+        self.__build_routes()
+
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Steps are collected once per class, a subclass attribute replaces the base step of the same name,
+        # and is no step if it is not decorated as one
+        cls._step_names = {}
+        for klass in reversed(cls.__mro__):
+            for attr_name, attr in vars(klass).items():
+                if callable(attr) and hasattr(attr, 'step_number'):
+                    cls._step_names[attr_name] = attr.step_number
+                else:
+                    cls._step_names.pop(attr_name, None)
+
+
+    def __build_routes(self):
+        routes: dict[int, dict[str, callable]] = {}
+        messages: dict[int, list[MessageHandler]] = {}
+        for attr_name in self._step_names:
+            step = getattr(self, attr_name)
+            if step.step_number not in routes:
+                routes[step.step_number] = {'action': self.__process_action}
+                messages[step.step_number] = []
                 self.GO_TO_CONVERSATION_END += 1
             if step.type == StepTrigger.MESSAGE:
-                handler = MessageHandler(filters.TEXT & ~filters.COMMAND, step)
+                messages[step.step_number].append(MessageHandler(filters.TEXT & ~filters.COMMAND, step))
             elif step.type == StepTrigger.BUTTON:
-                handler = CallbackQueryHandler(step, pattern=step.pattern)
-            self._states[step.step_number].append(handler)
-
+                routes[step.step_number][step.prefix] = step
+        for step_number, step_routes in routes.items():
+            self._states[step_number] = [ButtonRouter(step_routes), *messages[step_number]]
 
 
     def _print_debug(self):
@@ -138,14 +222,38 @@ class BaseConversation(ConversationHandler):
             return await self.cancel(update, context)
         if answer == 'back':
             # restore message
-            step_no, text, markup = context.user_data['step_cache'].pop()
-            await edit_text(update, text, markup)
+            step_cache = context.user_data.get('step_cache')
+            if not step_cache:
+                return None # history lost (e.g. timed out), stay on the current step
+            step_no, text, keyboard = step_cache.pop()
+            await edit_text(update, text, restore_keyboard(keyboard))
             return step_no
 
 
+    def active_steps(self) -> dict[object, int]:
+        """
+        Number of conversations in progress per current step.
+        """
+        counts = {}
+        for state in self._conversations.values():
+            state = getattr(state, 'old_state', state) # step whose non-blocking handler is still running
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+
     @property
     def steps(self):
-        return len(self._states) - 1 # Do not count entry point
+        return sum(1 for state in self._states if state >= 0) # Do not count entry point and timeout
+
+
+    def users_in_progress(self) -> set[int]:
+        return {key[-1] for key in self._conversations}
+
+
+    async def _timed_out(self, update: Update, context: CallbackContext):
+        # Another conversation of the user may have taken over user_data since
+        if context.user_data.get('conversation') == self.name:
+            context.user_data.clear()
 
 
     async def cancel(self, update: Update, context: CallbackContext):
@@ -167,3 +275,17 @@ class BaseConversation(ConversationHandler):
     async def _process_result(self, update: Update, result: CallbackContext):
         # Should be defined in derived class
         pass
+
+
+def reap_user_data(application: Application, conversations: list[BaseConversation], idle: float = CONVERSATION_TIMEOUT) -> int:
+    """
+    Drop the user_data of users with no conversation in progress whose last step is older than idle seconds.
+    :return: number of users dropped
+    """
+    in_progress = set().union(*(conversation.users_in_progress() for conversation in conversations))
+    stale_before = time.time() - idle
+    stale = [user_id for user_id, data in application.user_data.items()
+             if user_id not in in_progress and data.get('last_step_at', 0) < stale_before]
+    for user_id in stale:
+        application.drop_user_data(user_id)
+    return len(stale)
@@ -86,8 +86,6 @@ class EditConversation(BaseConversation):
     async def _process_result(self, update: Update, context: CallbackContext):
         chat_id = update.effective_chat.id
         sub = self.storage.remove_sub(chat_id, context.user_data['task'])
-        for job in context.job_queue.get_jobs_by_name(f'{context.user_data['task']}_{chat_id}'):
-            job.schedule_removal()
         if 'new_hour' in context.user_data:
             sub.hour = int(context.user_data['new_hour'])
             sub.minute = int(context.user_data['new_minute'])
@@ -0,0 +1,131 @@
+import os
+import time
+import asyncio
+import logging
+import subprocess
+
+from .metrics import FFMPEG_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ENCODERS = os.cpu_count() or 1 # ffmpeg processes running at the same time
+MAX_QUEUED_ENCODES = 4 * MAX_ENCODERS # submissions wait (backpressure) once this many encodes are queued
+ENCODE_TIMEOUT = 60 # seconds an encode may run before its ffmpeg is killed
+
+
+class EncodeJob:
+    __slots__ = ('cmd', 'timeout', 'future')
+
+    def __init__(self, cmd: list[str], timeout: float, future: asyncio.Future):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.future = future
+
+
+class EncoderPool:
+    """
+    Fixed number of workers running ffmpeg commands from a bounded queue.
+    Submitting waits while the queue is full, so a large delivery slows down instead of forking an encoder per track.
+    An encode whose submitter was cancelled (e.g. its delivery was dropped) is skipped, or killed if already running.
+    """
+
+    def __init__(self, workers: int = MAX_ENCODERS, queue_size: int = MAX_QUEUED_ENCODES):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue: asyncio.Queue[EncodeJob] = None
+        self._tasks: list[asyncio.Task] = []
+        self._loop: asyncio.AbstractEventLoop = None
+
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue(self.queue_size)
+        self._tasks = [loop.create_task(self._work(), name=f'encoder-{i}') for i in range(self.workers)]
+
+
+    async def run(self, cmd: list[str], timeout: float = ENCODE_TIMEOUT) -> bytes:
+        """
+        Run an ffmpeg command in the pool.
+        :return: stdout of the command
+        :raise subprocess.CalledProcessError: ffmpeg failed
+        :raise TimeoutError: the command ran longer than timeout seconds
+        """
+        self._start()
+        job = EncodeJob(cmd, timeout, self._loop.create_future())
+        await self._queue.put(job)
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+
+
+    async def close(self):
+        """
+        Stop the workers on shutdown, encodes still queued are abandoned.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks, self._loop = [], None
+
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                if not job.future.done():
+                    await self._execute(job)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+
+    async def _execute(self, job: EncodeJob):
+        start = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(*job.cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        communicate = asyncio.ensure_future(proc.communicate())
+        try:
+            # Wakes up when ffmpeg exits, its submitter gives up or the timeout expires
+            await asyncio.wait([communicate, job.future], timeout=job.timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            timed_out = not communicate.done()
+            if timed_out:
+                proc.kill()
+                await communicate
+            FFMPEG_SECONDS.observe(time.perf_counter() - start)
+
+        if job.future.done():
+            logger.debug(f'Dropped cancelled encode of {job.cmd[-1]}')
+        elif timed_out:
+            logger.warning(f'Encode of {job.cmd[-1]} killed after {job.timeout}s')
+            job.future.set_exception(TimeoutError(f'ffmpeg did not finish in {job.timeout}s'))
+        elif proc.returncode != 0:
+            job.future.set_exception(subprocess.CalledProcessError(proc.returncode, job.cmd))
+        else:
+            job.future.set_result(communicate.result()[0])
+
+
+_encoder: EncoderPool = None
+
+
+def get_encoder() -> EncoderPool:
+    global _encoder
+    if _encoder is None:
+        _encoder = EncoderPool()
+    return _encoder
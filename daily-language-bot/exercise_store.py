@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import pathlib
+from array import array
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+EXERCISE_TTL = 2 * 24 * 3600 # seconds an exercise can be answered
+MAX_CACHED_EXERCISES = 10_000
+FLUSH_INTERVAL = 5 # seconds
+SWEEP_INTERVAL = 3600 # seconds
+
+
+class Exercise:
+    """
+    Compact record of an exercise sent to a chat.
+    values holds the numbers of a numbers exercise or the strings of a verbs exercise.
+    """
+    __slots__ = ('task', 'language', 'values', 'expires', 'shared_key')
+
+    def __init__(self, task: str, language: str, values: array | tuple, expires: float = None, shared_key: str = None):
+        self.task = task
+        self.language = language
+        self.values = values
+        self.expires = expires if expires is not None else time.time() + EXERCISE_TTL
+        self.shared_key = shared_key # set for exercises delivered to a whole cohort
+
+
+    # numbers exercise: three equal parts - numbers to translate, text numbers, audio numbers
+    @property
+    def numerical(self) -> array:
+        return self.values[:len(self.values) // 3]
+
+    @property
+    def text(self) -> array:
+        return self.values[len(self.values) // 3:len(self.values) * 2 // 3]
+
+    @property
+    def audio(self) -> array:
+        return self.values[len(self.values) * 2 // 3:]
+
+
+    @property
+    def expired(self) -> bool:
+        return self.expires < time.time()
+
+
+    def to_json(self) -> dict:
+        values = self.values.tolist() if isinstance(self.values, array) else list(self.values)
+        return {'task': self.task, 'language': self.language, 'values': values, 'numeric': isinstance(self.values, array),
+                'expires': self.expires, 'shared_key': self.shared_key}
+
+
+    @classmethod
+    def from_json(cls, raw: dict) -> 'Exercise':
+        values = array('I', raw['values']) if raw['numeric'] else tuple(raw['values'])
+        return cls(raw['task'], raw['language'], values, raw['expires'], raw['shared_key'])
+
+
+class ExerciseStore:
+    """
+    Active exercise per chat, bounded in memory (LRU) and persisted incrementally under data_dir/exercises.
+    A chat's record is read from disk only when it is not in memory, e.g. when the chat answers after a restart.
+    Exercises shared by a cohort are kept and persisted once, chats only refer to them.
+    """
+
+    def __init__(self, storage_dir: pathlib.Path, max_cached: int = MAX_CACHED_EXERCISES):
+        self.storage_dir = storage_dir
+        self.shared_dir = storage_dir / 'shared'
+        self.shared_dir.mkdir(parents=True, exist_ok=True)
+        self.max_cached = max_cached
+        self._cache: OrderedDict[int, Exercise] = OrderedDict()
+        self._shared: dict[str, Exercise] = {}
+        self._dirty: dict[int, Exercise] = {} # not yet persisted, kept outside of the LRU so eviction cannot lose them
+        self._dirty_shared: dict[str, Exercise] = {}
+
+
+    def __len__(self):
+        return len(self._cache)
+
+
+    def _path(self, chat_id: int) -> pathlib.Path:
+        return self.storage_dir / f'{chat_id}.json'
+
+
+    def _shared_path(self, key: str) -> pathlib.Path:
+        return self.shared_dir / f'{hashlib.sha1(key.encode()).hexdigest()}.json'
+
+
+    def _remember(self, chat_id: int, exercise: Exercise):
+        self._cache[chat_id] = exercise
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+
+    def put(self, chat_id: int, exercise: Exercise):
+        if exercise.shared_key is not None:
+            if exercise.shared_key in self._shared:
+                # Copies of a shared exercise (e.g. received from a shard worker) are not kept per chat
+                exercise = self._shared[exercise.shared_key]
+            else:
+                self._shared[exercise.shared_key] = exercise
+                self._dirty_shared[exercise.shared_key] = exercise
+        self._remember(chat_id, exercise)
+        self._dirty[chat_id] = exercise
+
+
+    def get(self, chat_id: int) -> Exercise | None:
+        exercise = self._cache.get(chat_id)
+        if exercise is not None:
+            self._cache.move_to_end(chat_id)
+        else:
+            exercise = self._dirty.get(chat_id) or self._read(chat_id)
+            if exercise is None:
+                return None
+            self._remember(chat_id, exercise)
+
+        if exercise.expired:
+            self.remove(chat_id)
+            return None
+        return exercise
+
+
+    def remove(self, chat_id: int):
+        self._cache.pop(chat_id, None)
+        self._dirty.pop(chat_id, None)
+        self._path(chat_id).unlink(missing_ok=True)
+
+
+    def _read(self, chat_id: int) -> Exercise | None:
+        try:
+            with open(self._path(chat_id), 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if 'ref' not in raw:
+            return Exercise.from_json(raw)
+
+        shared = self._shared.get(raw['ref'])
+        if shared is None:
+            try:
+                with open(self._shared_path(raw['ref']), 'r', encoding='utf-8') as f:
+                    shared = Exercise.from_json(json.load(f))
+            except (FileNotFoundError, ValueError):
+                return None
+            self._shared[raw['ref']] = shared
+        return shared
+
+
+    @staticmethod
+    def _write(path: pathlib.Path, raw: dict):
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(raw, f)
+        tmp.replace(path)
+
+
+    def _write_batch(self, chats: dict[int, Exercise], shared: dict[str, Exercise]):
+        # Shared exercises first, so a chat never refers to a missing one
+        for key, exercise in shared.items():
+            self._write(self._shared_path(key), exercise.to_json())
+        for chat_id, exercise in chats.items():
+            raw = {'ref': exercise.shared_key} if exercise.shared_key is not None else exercise.to_json()
+            self._write(self._path(chat_id), raw)
+
+
+    def _take_dirty(self) -> tuple[dict[int, Exercise], dict[str, Exercise]]:
+        chats, self._dirty = self._dirty, {}
+        shared, self._dirty_shared = self._dirty_shared, {}
+        return chats, shared
+
+
+    def flush(self):
+        self._write_batch(*self._take_dirty())
+
+
+    async def flush_job(self, context):
+        if not self._dirty and not self._dirty_shared:
+            return
+        chats, shared = self._take_dirty()
+        try:
+            await asyncio.to_thread(self._write_batch, chats, shared)
+        except OSError as e:
+            logger.error(f'Failed to persist {len(chats)} exercises: {e}')
+            self._dirty = chats | self._dirty
+            self._dirty_shared = shared | self._dirty_shared
+
+
+    def _sweep(self) -> int:
+        deadline = time.time() - EXERCISE_TTL
+        removed = 0
+        for directory in (self.storage_dir, self.shared_dir):
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+
+    async def sweep_job(self, context):
+        self._shared = {key: exercise for key, exercise in self._shared.items() if not exercise.expired}
+        removed = await asyncio.to_thread(self._sweep)
+        if removed:
+            logger.info(f'Removed {removed} expired exercises')
+
+
+_stores: dict[pathlib.Path, ExerciseStore] = {}
+
+
+def get_exercise_store(data_dir: pathlib.Path) -> ExerciseStore:
+    store = _stores.get(data_dir)
+    if store is None:
+        store = _stores[data_dir] = ExerciseStore(data_dir / 'exercises')
+    return store
+
+
+def set_exercise_store(data_dir: pathlib.Path, store):
+    """
+    Replace the store exercises of data_dir are recorded in, e.g. in shard workers which forward them to the coordinator.
+    """
+    _stores[data_dir] = store
@@ -0,0 +1,157 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import pathlib
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ENTRIES = 50_000
+MIN_COMPACT_RECORDS = 1_000 # smaller logs are not worth compacting while running
+
+
+class FileIdCache:
+    """
+    Persistent map from audio content hash to the Telegram file_id it was uploaded as.
+    Changes are appended to a log which is compacted once it outgrows the live entries:
+    on load, and off the event loop while running.
+    """
+
+    def __init__(self, storage_path: pathlib.Path, max_entries: int = MAX_ENTRIES):
+        self.storage_path = storage_path
+        self.max_entries = max_entries
+        self.data: dict[str, str] = {}
+        self.records = 0 # lines in the log
+        self._compaction: asyncio.Task = None
+        self._appended: list[str] | None = None # lines appended while a compaction runs
+        self._load()
+        self._log = open(self.storage_path, 'a', encoding='utf-8')
+
+
+    @staticmethod
+    def digest(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+
+    def _load(self):
+        if not self.storage_path.exists():
+            return
+        records = 0
+        with open(self.storage_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    digest, file_id = json.loads(line)
+                except ValueError:
+                    logger.warning(f'Skipping broken record in {self.storage_path}')
+                    continue
+                records += 1
+                self.data.pop(digest, None)
+                if file_id is not None:
+                    self.data[digest] = file_id
+        self._trim()
+        self.records = records
+        if self._outgrown(0):
+            self._compact()
+        logger.debug(f'Loaded {len(self.data)} file ids from {self.storage_path}')
+
+
+    def _outgrown(self, min_records: int) -> bool:
+        return self.records > max(2 * len(self.data), min_records)
+
+
+    @staticmethod
+    def _write(path: pathlib.Path, entries: list[tuple[str, str]]):
+        with open(path, 'w', encoding='utf-8') as f:
+            for digest, file_id in entries:
+                f.write(json.dumps([digest, file_id]) + '\n')
+
+
+    def _compact(self):
+        tmp = self.storage_path.with_suffix('.tmp')
+        self._write(tmp, self.data.items())
+        tmp.replace(self.storage_path)
+        self.records = len(self.data)
+
+
+    async def compact(self):
+        """
+        Rewrite the log with the live entries, in a thread; changes made meanwhile are carried over.
+        """
+        tmp = self.storage_path.with_suffix('.tmp')
+        entries = list(self.data.items())
+        self._appended = []
+        try:
+            await asyncio.to_thread(self._write, tmp, entries)
+            with open(tmp, 'a', encoding='utf-8') as f:
+                f.writelines(self._appended)
+            self._log.close()
+            tmp.replace(self.storage_path)
+            self._log = open(self.storage_path, 'a', encoding='utf-8')
+            self.records = len(entries) + len(self._appended)
+            logger.info(f'Compacted {self.storage_path} to {self.records} records')
+        except OSError as e:
+            logger.error(f'Failed to compact {self.storage_path}: {e}')
+            if self._log.closed:
+                self._log = open(self.storage_path, 'a', encoding='utf-8')
+        finally:
+            self._appended = None
+            self._compaction = None
+
+
+    def _trim(self):
+        # dict keeps insertion order, so the oldest uploads go first
+        while len(self.data) > self.max_entries:
+            del self.data[next(iter(self.data))]
+
+
+    def _append(self, digest: str, file_id: str | None):
+        line = json.dumps([digest, file_id]) + '\n'
+        self._log.write(line)
+        self._log.flush()
+        self.records += 1
+        if self._appended is not None:
+            self._appended.append(line)
+        elif self._compaction is None and self._outgrown(MIN_COMPACT_RECORDS):
+            try:
+                self._compaction = asyncio.get_running_loop().create_task(self.compact())
+            except RuntimeError: # no event loop, e.g. in scripts
+                self._log.close()
+                self._compact()
+                self._log = open(self.storage_path, 'a', encoding='utf-8')
+
+
+    def get(self, digest: str) -> str | None:
+        return self.data.get(digest)
+
+
+    def put(self, digest: str, file_id: str):
+        self.data.pop(digest, None)
+        self.data[digest] = file_id
+        self._trim()
+        self._append(digest, file_id)
+
+
+    def invalidate(self, digest: str):
+        if self.data.pop(digest, None) is not None:
+            logger.info(f'Invalidating file id for {digest}')
+            self._append(digest, None)
+
+
+_caches: dict[pathlib.Path, FileIdCache] = {}
+
+
+def get_file_id_cache(data_dir: pathlib.Path) -> FileIdCache:
+    cache = _caches.get(data_dir)
+    if cache is None:
+        os.makedirs(data_dir, exist_ok=True)
+        cache = _caches[data_dir] = FileIdCache(data_dir / 'file_ids.jsonl')
+    return cache
+
+
+def set_file_id_cache(data_dir: pathlib.Path, cache: FileIdCache):
+    """
+    Replace the cache used for data_dir, e.g. in shard workers which must not share one log file.
+    """
+    _caches[data_dir] = cache
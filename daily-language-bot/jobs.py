@@ -1,17 +1,27 @@
+import math
 import logging
 import random
 import os
 import pathlib
+from array import array
 from enum import StrEnum
+from dataclasses import dataclass
 
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 from telegram import InputFile
+from telegram.error import BadRequest
 
-from .numbers_de import NUMBERS
-from .audio import generate_voice_track, get_duration
+from .numbers_de import NUMBERS, NUMBER_RANGE
+from .audio import generate_voice_track, get_duration, prefetch_clips
+from .file_id_cache import FileIdCache, get_file_id_cache
+from .exercise_store import Exercise, get_exercise_store
+from .rate_limiter import BROADCAST
+from .verbs import get_verb_catalogue, verbs_path
 
 DAILY_NUMBERS_BATCH_SIZE = 3
+# Parts of the Bot API errors for a file_id Telegram no longer accepts, lowercase
+FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file reference expired', 'file_reference_expired')
 
 
 
@@ -34,69 +44,148 @@ LanguageEmoji = {
 }
 
 
-async def send_daily_numbers(context: ContextTypes.DEFAULT_TYPE):
-    chat_id = context.job.chat_id
-    language = context.job.data['language']
-    logger.info(f'Sending daily numbers to chat {chat_id}')
+@dataclass
+class RenderedExercise:
+    """
+    Exercise ready to be sent: message text and voice track.
+    """
+    message: str
+    parse_mode: str
+    track: bytes
+    track_name: str
+    duration: int
+    notify_voice: bool = True
+
+
+async def render_track(words: list[str], data_dir: pathlib.Path, lang: str) -> tuple[bytes, int]:
+    track_file = await generate_voice_track(words, audio_dir=os.path.join(data_dir, 'audio'), lang=lang)
+    try:
+        with open(track_file, 'rb') as audio_file:
+            content = audio_file.read()
+        return content, math.ceil(await get_duration(track_file, content))
+    finally:
+        os.remove(track_file)
+
+
+def _is_file_id_error(error: BadRequest) -> bool:
+    message = error.message.casefold()
+    return any(marker in message for marker in FILE_ID_ERRORS)
+
+
+async def send_voice_track(context: ContextTypes.DEFAULT_TYPE, chat_id: int, content: bytes, duration: int, filename: str, **kwargs):
+    # Identical tracks are re-sent by their Telegram file_id instead of being uploaded again
+    file_ids = get_file_id_cache(pathlib.Path(context.job.data['data_dir']))
+    digest = FileIdCache.digest(content)
+    file_id = file_ids.get(digest)
+    if file_id is not None:
+        try:
+            await context.bot.send_voice(chat_id, file_id, duration=duration, rate_limit_args=BROADCAST, **kwargs)
+            return
+        except BadRequest as e:
+            # Errors of the chat, e.g. voice messages forbidden, say nothing about the file id
+            if not _is_file_id_error(e):
+                raise
+            logger.warning(f'Cached file id for {digest} was rejected: {e}')
+            file_ids.invalidate(digest)
+
+    message = await context.bot.send_voice(
+        chat_id,
+        InputFile(content, filename=filename),
+        duration=duration,
+        rate_limit_args=BROADCAST,
+        **kwargs
+    )
+    file_ids.put(digest, message.voice.file_id)
+
+
+async def send_rendered(context: ContextTypes.DEFAULT_TYPE, chat_id: int, rendered: RenderedExercise):
+    await context.bot.send_message(chat_id, rendered.message, parse_mode=rendered.parse_mode, rate_limit_args=BROADCAST)
+    await send_voice_track(context, chat_id, rendered.track, rendered.duration, rendered.track_name,
+                           disable_notification=not rendered.notify_voice)
+
 
-    nums = random.sample(range(1, 100), DAILY_NUMBERS_BATCH_SIZE * 3)
-    nums_numerical, nums_text, nums_audio = (nums[:DAILY_NUMBERS_BATCH_SIZE],
-                                             nums[DAILY_NUMBERS_BATCH_SIZE:DAILY_NUMBERS_BATCH_SIZE * 2],
-                                             nums[DAILY_NUMBERS_BATCH_SIZE * 2:])
+def make_numbers_exercise(language: str, rng: random.Random = random) -> Exercise:
+    # numbers to translate, text numbers and audio numbers, DAILY_NUMBERS_BATCH_SIZE each
+    nums = rng.sample(NUMBER_RANGE, DAILY_NUMBERS_BATCH_SIZE * 3)
+    return Exercise(JobTypes.NUMBERS.value, language, array('I', nums))
 
-    context.bot_data[chat_id] = {
-        'task':      'numbers',
-        'language':  language,
-        'numerical': nums_numerical,
-        'text':      nums_text,
-        'audio':     nums_audio,
-    }
 
+async def prepare_daily_numbers(data_dir: pathlib.Path, language: str, count: int, seed: str = None) -> list[Exercise]:
+    """
+    Generate exercises for a batch of deliveries, rendering the clips they need once for the whole batch.
+    :param seed: if given, the same seed always gives the same exercises
+    """
+    rng = random.Random(seed) if seed is not None else random
+    exercises = [make_numbers_exercise(language, rng) for _ in range(count)]
+    words = {NUMBERS[language][n] for exercise in exercises for n in exercise.audio}
+    await prefetch_clips(list(words), os.path.join(data_dir, 'audio'), language.lower())
+    return exercises
+
+
+async def render_daily_numbers(data_dir: pathlib.Path, exercise: Exercise) -> RenderedExercise:
+    language = exercise.language
     message = (
        f'📘{LanguageEmoji[language]} *Daily Numbers*\n\n'
-        '🔢 *Numbers (translate)*\n' + '  '.join(map(str, nums_numerical)) + '\n\n' +
-        '📝 *Text Numbers*\n\n' + '\n'.join(NUMBERS[language][n] for n in nums_text) + '\n\n' +
+        '🔢 *Numbers (translate)*\n' + '  '.join(map(str, exercise.numerical)) + '\n\n' +
+        '📝 *Text Numbers*\n\n' + '\n'.join(NUMBERS[language][n] for n in exercise.text) + '\n\n' +
         '🔊 *Audio Numbers*\n'
         '(see audio message below)'
     )
-
-    await context.bot.send_message(chat_id, message, parse_mode=ParseMode.MARKDOWN)
-
-    audio_dir = os.path.join(context.job.data['data_dir'], 'audio')
-    audio_track_file = generate_voice_track([NUMBERS[language][n] for n in nums_audio], audio_dir=audio_dir, out_name='daily_numbers.ogg', lang=language.lower())
-    audio_file = open(audio_track_file, 'rb')
-    await context.bot.send_voice(
-        chat_id,
-        InputFile(audio_file, filename='daily_numbers.ogg'),
-        duration=get_duration(audio_track_file),
-        disable_notification=True
-    )
+    track, duration = await render_track([NUMBERS[language][n] for n in exercise.audio], data_dir, language.lower())
+    return RenderedExercise(message, ParseMode.MARKDOWN, track, 'daily_numbers.ogg', duration, notify_voice=False)
 
 
-async def send_daily_verbs(context: ContextTypes.DEFAULT_TYPE):
+async def send_daily_numbers(context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.job.chat_id
     language = context.job.data['language']
-    logger.info(f'Sending daily verbs to chat {chat_id}')
+    logger.info(f'Sending daily numbers to chat {chat_id}')
+
+    exercise = context.job.data.get('exercise') or make_numbers_exercise(language)
+    rendered = context.job.data.get('rendered') or await render_daily_numbers(context.job.data['data_dir'], exercise)
+    get_exercise_store(pathlib.Path(context.job.data['data_dir'])).put(chat_id, exercise)
+    await send_rendered(context, chat_id, rendered)
+
+
+def pick_verb(data_dir: pathlib.Path, language: str, rng: random.Random = random) -> str:
+    return get_verb_catalogue(verbs_path(data_dir, language)).random_line(rng)
+
+
+def make_verbs_exercise(line: str, language: str) -> Exercise:
+    # infinitive, past, participle, translation
+    return Exercise(JobTypes.VERBS.value, language, tuple(line.strip().split(';')[:4]))
+
+
+async def prepare_daily_verbs(data_dir: pathlib.Path, language: str, count: int, seed: str = None) -> list[Exercise]:
+    """
+    Pick verbs for a batch of deliveries, rendering the clips once for the whole batch.
+    :param seed: if given, the same seed always gives the same verbs (as long as the verbs file is unchanged)
+    """
+    rng = random.Random(seed) if seed is not None else random
+    exercises = [make_verbs_exercise(pick_verb(data_dir, language, rng), language) for _ in range(count)]
+    forms = {form for exercise in exercises for form in exercise.values[:3]}
+    await prefetch_clips(list(forms), os.path.join(data_dir, 'audio'), language)
+    return exercises
 
-    with open(pathlib.Path(context.job.data['data_dir']) / f'verbs_{language.lower()}.txt', 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        todays = lines[random.randint(0, len(lines))].split(';')
-        verb = todays[0]
-        verb_forms = todays[:3]
-        translation = todays[3]
 
+async def render_daily_verbs(data_dir: pathlib.Path, exercise: Exercise) -> RenderedExercise:
+    language = exercise.language
+    verb_forms = exercise.values[:3]
+    translation = exercise.values[3]
     message = (
         f'📖{LanguageEmoji[language]} <b>Daily Irregular verbs</b>\n\n'
-        f'<b>{verb}</b> - <tg-spoiler>{translation}</tg-spoiler>\n'
+        f'<b>{verb_forms[0]}</b> - <tg-spoiler>{translation}</tg-spoiler>\n'
         f'Forms: <tg-spoiler><b>{verb_forms[0]} - {verb_forms[1]} - {verb_forms[2]}</b></tg-spoiler>'
     )
+    track, duration = await render_track(verb_forms, data_dir, language)
+    return RenderedExercise(message, ParseMode.HTML, track, 'daily_verbs.ogg', duration)
 
-    await context.bot.send_message(chat_id, message, parse_mode=ParseMode.HTML)
-    audio_dir = os.path.join(context.job.data['data_dir'], 'audio')
-    audio_track_file = generate_voice_track(verb_forms, audio_dir=audio_dir, out_name='daily_numbers.ogg', lang=language)
-    audio_file = open(audio_track_file, 'rb')
-    await context.bot.send_voice(
-        chat_id,
-        InputFile(audio_file, filename='daily_numbers.ogg'),
-        duration=get_duration(audio_track_file),
-    )
+
+async def send_daily_verbs(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = context.job.chat_id
+    language = context.job.data['language']
+    logger.info(f'Sending daily verbs to chat {chat_id}')
+
+    exercise = context.job.data.get('exercise') or make_verbs_exercise(pick_verb(context.job.data['data_dir'], language), language)
+    rendered = context.job.data.get('rendered') or await render_daily_verbs(context.job.data['data_dir'], exercise)
+    get_exercise_store(pathlib.Path(context.job.data['data_dir'])).put(chat_id, exercise)
+    await send_rendered(context, chat_id, rendered)
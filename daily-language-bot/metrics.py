@@ -0,0 +1,192 @@
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'daily_language_bot'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300) # seconds
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+READ_TIMEOUT = 5 # seconds a scraper gets to send its request
+
+METRICS: list['Metric'] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(ABC):
+    """
+    Metric exposed in the Prometheus text format, label values are passed positionally in the order of labels.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = f'{PREFIX}_{name}'
+        self.description = description
+        self.labels = labels
+        METRICS.append(self)
+
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        ...
+
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}', *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._values: dict[tuple, float] = {}
+
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.labels, values)} {value}' for values, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge read from a function when scraped: a number, or a dict from label values to numbers.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self._function: Callable[[], float | dict[tuple, float]] = None
+
+
+    def set_function(self, function: Callable[[], float | dict[tuple, float]]):
+        self._function = function
+
+
+    def samples(self) -> list[str]:
+        if self._function is None:
+            return []
+        values = self._function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}' for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {} # label values -> [count per bucket (+Inf last), sum]
+
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+
+    @contextmanager
+    def time(self, *label_values):
+        """
+        Observe the seconds spent in the with block, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+
+    def samples(self) -> list[str]:
+        lines = []
+        for values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, values)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, values)} {cumulative}')
+        return lines
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
+
+
+TTS_SECONDS = Histogram('tts_seconds', 'Time to synthesize a clip with the TTS engine', ('lang',))
+FFMPEG_SECONDS = Histogram('ffmpeg_seconds', 'Run time of ffmpeg encodes, without the time queued in the encoder pool')
+PROBE_SECONDS = Histogram('duration_probe_seconds', 'Time to read the duration of a voice track', ('method',))
+SEND_SECONDS = Histogram('telegram_send_seconds', 'Latency of Bot API requests to chats, without rate limiting', ('endpoint',))
+JOB_LAG_SECONDS = Histogram('delivery_start_lag_seconds', 'Delay between the scheduled time of a delivery and its start', ('task',))
+HANDLER_SECONDS = Histogram('handler_seconds', 'Run time of conversation steps and delivery jobs while profiling', ('handler',))
+STORAGE_SECONDS = Histogram('sub_storage_seconds', 'Time to load, restore, save and compact the subscriptions', ('operation',))
+DELIVERIES = Counter('deliveries_total', 'Exercises delivered', ('task', 'lang'))
+DELIVERY_FAILURES = Counter('delivery_failures_total', 'Deliveries that failed or timed out', ('task', 'lang'))
+SCHEDULED = Gauge('scheduled_subscriptions', 'Subscriptions registered for delivery')
+ACTIVE_EXERCISES = Gauge('active_exercises', 'Exercises waiting for an answer, held in memory')
+CONVERSATIONS = Gauge('conversations', 'Conversations in progress per step', ('conversation', 'state'))
+
+
+class MetricsServer:
+    """
+    Minimal HTTP listener serving the metrics at /metrics, run on the bot's event loop.
+    """
+
+    def __init__(self, listen: str, port: int):
+        self.listen = listen
+        self.port = port
+        self._server: asyncio.Server = None
+
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        logger.info(f'Serving metrics at http://{self.listen}:{self.port}/metrics')
+
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), READ_TIMEOUT)
+            method, path, *_ = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+            if method == 'GET' and path.split('?', 1)[0] == '/metrics':
+                status, body = '200 OK', render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass # malformed or abandoned request
+        finally:
+            writer.close()
@@ -1,21 +1,30 @@
-NUMBERS = {
+import re
+from functools import lru_cache
+
+
+# Numbers used by the daily exercises
+NUMBER_RANGE = range(1, 100)
+MAX_NUMBER = 999_999
+
+MAX_WORDS_PER_NUMBER = 8 # longest 'twenty one thousand ...' group tried when splitting English answers
+
+
+UNITS = {
+    'DE': {1: 'eins', 2: 'zwei', 3: 'drei', 4: 'vier', 5: 'fünf', 6: 'sechs', 7: 'sieben', 8: 'acht', 9: 'neun'},
+    'EN': {1: 'one', 2: 'two', 3: 'three', 4: 'four', 5: 'five', 6: 'six', 7: 'seven', 8: 'eight', 9: 'nine'},
+}
+
+TEENS = {
     'DE': {
-        1: 'eins', 2: 'zwei', 3: 'drei', 4: 'vier', 5: 'fünf',
-        6: 'sechs', 7: 'sieben', 8: 'acht', 9: 'neun', 10: 'zehn',
-        11: 'elf', 12: 'zwölf', 13: 'dreizehn', 14: 'vierzehn',
-        15: 'fünfzehn', 16: 'sechzehn', 17: 'siebzehn', 18: 'achtzehn',
-        19: 'neunzehn'
+        10: 'zehn', 11: 'elf', 12: 'zwölf', 13: 'dreizehn', 14: 'vierzehn',
+        15: 'fünfzehn', 16: 'sechzehn', 17: 'siebzehn', 18: 'achtzehn', 19: 'neunzehn'
     },
     'EN': {
-        1: 'one', 2: 'two', 3: 'three', 4: 'four', 5: 'five',
-        6: 'six', 7: 'seven', 8: 'eight', 9: 'nine', 10: 'ten',
-        11: 'eleven', 12: 'twelve', 13: 'thirteen', 14: 'fourteen',
-        15: 'fifteen', 16: 'sixteen', 17: 'seventeen', 18: 'eighteen',
-        19: 'nineteen'
-    }
+        10: 'ten', 11: 'eleven', 12: 'twelve', 13: 'thirteen', 14: 'fourteen',
+        15: 'fifteen', 16: 'sixteen', 17: 'seventeen', 18: 'eighteen', 19: 'nineteen'
+    },
 }
 
-
 TENS = {
     'DE': {
         20: 'zwanzig', 30: 'dreißig', 40: 'vierzig', 50: 'fünfzig',
@@ -24,16 +33,195 @@ TENS = {
     'EN': {
         20: 'twenty', 30: 'thirty', 40: 'forty', 50: 'fifty',
         60: 'sixty', 70: 'seventy', 80: 'eighty', 90: 'ninety'
-    }
+    },
 }
 
+HUNDRED = {'DE': 'hundert', 'EN': 'hundred'}
+THOUSAND = {'DE': 'tausend', 'EN': 'thousand'}
+
+# Words accepted in answers but never produced
+FILLERS = {'DE': ('und',), 'EN': ('and',)}
+EXTRA_MORPHEMES = {'DE': {'ein': 1, 'null': 0}, 'EN': {'zero': 0}}
+
+TRANSLITERATION = str.maketrans({'ß': 'ss', 'ä': 'ae', 'ö': 'oe', 'ü': 'ue'})
+
+
+class NumberLexicon:
+    """
+    Number words of a language for 1..MAX_NUMBER, generated on demand and memoized.
+    Answers are read back with a trie over the normalized number morphemes in a single pass,
+    so no table of all numbers is ever built.
+    """
+
+    def __init__(self, language: str):
+        self.language = language
+        self.compound = language == 'DE' # German numbers are written as one word
+        self._trie = self._build_trie()
+
+
+    def normalize(self, text: str) -> str:
+        """
+        Lower case, ß/umlauts transliterated, hyphens and fillers resolved.
+        """
+        text = text.lower().translate(TRANSLITERATION).strip(' .,;!?')
+        if self.compound:
+            return text.replace('-', '').replace(' ', '')
+        words = text.replace('-', ' ').split()
+        return ' '.join(word for word in words if word not in FILLERS[self.language])
+
+
+    def _build_trie(self) -> dict:
+        morphemes = {**UNITS[self.language], **TEENS[self.language], **TENS[self.language],
+                     100: HUNDRED[self.language], 1000: THOUSAND[self.language]}
+        entries = {self.normalize(word): value for value, word in morphemes.items()}
+        entries.update(EXTRA_MORPHEMES[self.language])
+        entries.update({filler: None for filler in FILLERS[self.language]})
+
+        trie = {}
+        for word, value in entries.items():
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = value # end of morpheme
+        return trie
+
+
+    def __getitem__(self, number: int) -> str:
+        return self.words(number)
+
+
+    @lru_cache(maxsize=4096)
+    def words(self, number: int) -> str:
+        if not 0 < number <= MAX_NUMBER:
+            raise KeyError(number)
+        thousands, rest = divmod(number, 1000)
+        parts = []
+        if thousands:
+            parts.append(self._below_thousand(thousands, compound=True) + self._separator() + THOUSAND[self.language])
+        if rest:
+            parts.append(self._below_thousand(rest))
+        return self._separator().join(parts)
+
+
+    def _separator(self) -> str:
+        return '' if self.compound else ' '
+
+
+    def _unit(self, number: int, compound: bool) -> str:
+        # German 'eins' turns into 'ein' in front of another word: einundzwanzig, einhundert
+        return 'ein' if self.compound and number == 1 and compound else UNITS[self.language][number]
+
+
+    def _below_thousand(self, number: int, compound: bool = False) -> str:
+        hundreds, rest = divmod(number, 100)
+        parts = []
+        if hundreds:
+            parts.append(self._unit(hundreds, compound=True) + self._separator() + HUNDRED[self.language])
+        if rest:
+            parts.append(self._below_hundred(rest, compound))
+        return self._separator().join(parts)
+
+
+    def _below_hundred(self, number: int, compound: bool) -> str:
+        if number < 10:
+            return self._unit(number, compound)
+        if number < 20:
+            return TEENS[self.language][number]
+        tens, ones = divmod(number, 10)
+        if ones == 0:
+            return TENS[self.language][number]
+        if self.compound:
+            return self._unit(ones, compound=True) + 'und' + TENS['DE'][tens * 10]
+        return f'{TENS[self.language][tens * 10]} {UNITS[self.language][ones]}'
+
+
+    @lru_cache(maxsize=4096)
+    def _forms(self, number: int) -> frozenset[str]:
+        canonical = self.normalize(self.words(number))
+        forms = {canonical}
+        if self.compound:
+            # 'hundertzwei' / 'tausend' without the leading 'ein'
+            for big in ('hundert', 'tausend'):
+                if canonical.startswith('ein' + big):
+                    forms.add(canonical[3:])
+        return frozenset(forms)
+
+
+    def _parse(self, normalized: str) -> int | None:
+        total, current = 0, 0
+        pos = 0
+        while pos < len(normalized):
+            if normalized[pos] == ' ':
+                pos += 1
+                continue
+            # Longest morpheme starting at pos
+            node, value, end = self._trie, None, -1
+            for i in range(pos, len(normalized)):
+                node = node.get(normalized[i])
+                if node is None:
+                    break
+                if '' in node:
+                    value, end = node[''], i + 1
+            if end < 0:
+                return None
+            pos = end
+            if value is None: # filler
+                continue
+            if value == 100:
+                current = (current or 1) * 100
+            elif value == 1000:
+                total += (current or 1) * 1000
+                current = 0
+            else:
+                current += value
+        return total + current
+
+
+    def value(self, text: str) -> int | None:
+        """
+        Number written as text, or None if the text is not a correctly written number.
+        """
+        normalized = self.normalize(text)
+        if not normalized:
+            return None
+        number = self._parse(normalized)
+        if number is None or not 0 < number <= MAX_NUMBER or normalized not in self._forms(number):
+            return None
+        return number
+
+
+    def split_answers(self, text: str) -> list[str]:
+        """
+        Split a message into single answers. Lines and commas always separate answers;
+        multi-word English numbers are grouped greedily ('twenty one' is one answer).
+        A line that is not a run of correctly written numbers or digits is kept whole as one (wrong) answer,
+        so a typo does not shift the answers after it.
+        """
+        answers = []
+        for segment in re.split(r'[\n,;]', text):
+            words = segment.replace('-', ' ').split() if not self.compound else segment.split()
+            if not words:
+                continue
+            parts = []
+            i = 0
+            while i < len(words):
+                end = i + 1
+                if not self.compound:
+                    for j in range(min(len(words), i + MAX_WORDS_PER_NUMBER), i + 1, -1):
+                        if self.value(' '.join(words[i:j])) is not None:
+                            end = j
+                            break
+                part = ' '.join(words[i:end])
+                if not part.isdigit() and self.value(part) is None:
+                    parts = [segment.strip()]
+                    break
+                parts.append(part)
+                i = end
+            answers.extend(parts)
+        return answers
+
+
+LEXICONS = {language: NumberLexicon(language) for language in UNITS}
 
-for i in range(20, 100):
-    tens = (i // 10) * 10
-    ones = i % 10
-    if ones == 0:
-        NUMBERS['DE'][i] = TENS['DE'][i]
-        NUMBERS['EN'][i] = TENS['EN'][i]
-    else:
-        NUMBERS['DE'][i] = NUMBERS['DE'][ones] + 'und' + TENS['DE'][tens]
-        NUMBERS['EN'][i] = ' '.join([TENS['EN'][tens], NUMBERS['EN'][ones]])
+# NUMBERS[language][n] gives the words for n
+NUMBERS = LEXICONS
@@ -0,0 +1,58 @@
+import struct
+
+
+OGG_CAPTURE = b'OggS'
+OPUS_HEAD = b'OpusHead'
+OPUS_GRANULE_RATE = 48000 # Opus granule positions always count 48 kHz samples
+
+# Ogg page header: capture pattern, version, header type, granule position, serial, sequence, CRC, segment count
+PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+MAX_PAGE_SIZE = PAGE_HEADER.size + 255 + 255 * 255
+
+
+def _first_page(head: bytes) -> tuple[int, int]:
+    """
+    :return: serial number and pre-skip of the Opus stream starting in the first page
+    """
+    if len(head) < PAGE_HEADER.size:
+        raise ValueError('Not an Ogg stream')
+    capture, version, _, _, serial, _, _, segments = PAGE_HEADER.unpack_from(head)
+    if capture != OGG_CAPTURE or version != 0:
+        raise ValueError('Not an Ogg stream')
+    packet = PAGE_HEADER.size + segments
+    if head[packet:packet + len(OPUS_HEAD)] != OPUS_HEAD:
+        raise ValueError('Not an Opus stream')
+    pre_skip, = struct.unpack_from('<H', head, packet + 10)
+    return serial, pre_skip
+
+
+def _last_granule(tail: bytes, serial: int) -> int:
+    pos = len(tail)
+    while (pos := tail.rfind(OGG_CAPTURE, 0, pos)) >= 0:
+        if pos + PAGE_HEADER.size <= len(tail):
+            _, version, _, granule, page_serial, _, _, _ = PAGE_HEADER.unpack_from(tail, pos)
+            # -1 marks a page on which no packet finishes
+            if version == 0 and page_serial == serial and granule != -1:
+                return granule
+    raise ValueError('No final Ogg page found')
+
+
+def opus_duration(source: str | bytes) -> float:
+    """
+    Exact duration of an Ogg/Opus stream: the last page's granule position minus the OpusHead pre-skip.
+    Only the first and the last page are read.
+    :param source: Path to the file or its content
+    :return: Duration in seconds
+    """
+    if isinstance(source, bytes):
+        head, tail = source[:MAX_PAGE_SIZE], source[-MAX_PAGE_SIZE:]
+    else:
+        with open(source, 'rb') as f:
+            head = f.read(MAX_PAGE_SIZE)
+            size = f.seek(0, 2)
+            f.seek(max(0, size - MAX_PAGE_SIZE))
+            tail = f.read()
+
+    serial, pre_skip = _first_page(head)
+    granule = _last_granule(tail, serial)
+    return max(0, granule - pre_skip) / OPUS_GRANULE_RATE
@@ -0,0 +1,136 @@
+import io
+import time
+import random
+import asyncio
+import logging
+import pathlib
+import cProfile
+import pstats
+import traceback
+from datetime import datetime
+from functools import wraps
+
+from .metrics import HANDLER_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SAMPLE_RATE = 0.1 # share of invocations run under cProfile while profiling is on
+MIN_DUMP_INTERVAL = 60 # seconds between two dumps of the same handler
+MAX_DUMPS = 200 # newest reports kept in data_dir/profiles
+STATS_LINES = 40 # functions listed in a report, by cumulative time
+
+
+def _coroutine_stack(task: asyncio.Task) -> str:
+    # Task.get_stack() gives only the outermost frame of a suspended task, the awaited chain is followed by hand
+    frames = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append((frame, frame.f_lineno))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return ''.join(traceback.format_list(traceback.StackSummary.extract(frames)))
+
+
+class SlowPathProfiler:
+    """
+    Times handler invocations and reports those slower than threshold to data_dir/profiles.
+    A report holds where the handler was waiting once the threshold had passed and, for a sample of invocations,
+    a cProfile of the event loop thread over the whole invocation - which includes anything else that ran,
+    or blocked the loop, meanwhile.
+    """
+
+    def __init__(self, profiles_dir: pathlib.Path, threshold: float, sample_rate: float = PROFILE_SAMPLE_RATE):
+        self.profiles_dir = profiles_dir
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.profiles_dir.mkdir(parents=True, exist_ok=True)
+        self._profiling = False # a profile covers the whole thread, so one profiled invocation at a time
+        self._last_dump: dict[str, float] = {}
+
+
+    async def run(self, name: str, step: int | None, chat_id: int | None, func, args: tuple, kwargs: dict):
+        profile = None
+        if not self._profiling and random.random() < self.sample_rate:
+            profile = cProfile.Profile()
+            self._profiling = True
+        task = asyncio.current_task()
+        stack = []
+        watchdog = asyncio.get_running_loop().call_later(self.threshold, lambda: stack.append(_coroutine_stack(task)))
+        start = time.perf_counter()
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    self._profiling = False
+        finally:
+            elapsed = time.perf_counter() - start
+            watchdog.cancel()
+            HANDLER_SECONDS.observe(elapsed, name)
+            if elapsed >= self.threshold:
+                self._report(name, step, chat_id, elapsed, stack[0] if stack else None, profile)
+
+
+    def _report(self, name: str, step: int | None, chat_id: int | None, elapsed: float, stack: str | None, profile: cProfile.Profile | None):
+        now = time.monotonic()
+        last = self._last_dump.get(name)
+        if last is not None and now - last < MIN_DUMP_INTERVAL:
+            logger.debug(f'{name} took {elapsed:.2f}s, not dumped: reported {now - last:.0f}s ago')
+            return
+        self._last_dump[name] = now
+
+        where = f'{name}' if step is None else f'{name} step {step}'
+        stem = f'{datetime.now():%Y%m%d-%H%M%S}-{where.replace(" step ", "-step")}-chat{chat_id}'
+        lines = [f'{where} chat {chat_id}: {elapsed:.3f}s (threshold {self.threshold}s)', '']
+        if stack:
+            lines += [f'Awaiting after {self.threshold}s:', stack]
+        if profile is not None:
+            out = io.StringIO()
+            stats = pstats.Stats(profile, stream=out)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(STATS_LINES)
+            stats.dump_stats(self.profiles_dir / f'{stem}.prof')
+            lines += ['Event loop thread profile:', out.getvalue()]
+        (self.profiles_dir / f'{stem}.txt').write_text('\n'.join(lines), encoding='utf-8')
+        logger.warning(f'{where} for chat {chat_id} took {elapsed:.2f}s, see {self.profiles_dir / stem}.txt')
+        self._prune()
+
+
+    def _prune(self):
+        reports = sorted(self.profiles_dir.glob('*.txt'))
+        for report in reports[:-MAX_DUMPS]:
+            report.unlink(missing_ok=True)
+            report.with_suffix('.prof').unlink(missing_ok=True)
+
+
+_profiler: SlowPathProfiler = None
+
+
+def enable_profiling(data_dir: pathlib.Path, threshold: float, sample_rate: float = PROFILE_SAMPLE_RATE):
+    global _profiler
+    _profiler = SlowPathProfiler(data_dir / 'profiles', threshold, sample_rate)
+    logger.info(f'Profiling handlers slower than {threshold}s into {_profiler.profiles_dir}')
+
+
+async def profiled(name: str, step: int | None, chat_id: int | None, func, *args, **kwargs):
+    """
+    Await func(*args, **kwargs), timed and reported if it is slow while profiling is enabled.
+    """
+    if _profiler is None:
+        return await func(*args, **kwargs)
+    return await _profiler.run(name, step, chat_id, func, args, kwargs)
+
+
+def profiled_job(func):
+    """
+    Profile a delivery job, which gets the chat from its job context.
+    """
+    @wraps(func)
+    async def wrapper(context):
+        return await profiled(func.__name__, None, context.job.chat_id, func, context)
+    return wrapper
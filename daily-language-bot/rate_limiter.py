@@ -0,0 +1,171 @@
+import heapq
+import asyncio
+import logging
+import itertools
+from enum import IntEnum
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from .metrics import SEND_SECONDS
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram Bot API limits for outgoing messages
+GLOBAL_RATE = 30            # messages per second across all chats
+PRIVATE_CHAT_RATE = 1       # messages per second in a private chat
+GROUP_CHAT_RATE = 20 / 60   # messages per second in a group
+CHAT_BURST = 3
+
+MAX_CONCURRENT_REQUESTS = 32
+MAX_RETRIES = 3
+MAX_IDLE_CHAT_BUCKETS = 10_000
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0 # replies to user actions
+    BROADCAST = 1   # scheduled deliveries
+
+
+BROADCAST = {'priority': Priority.BROADCAST}
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = asyncio.get_running_loop().time()
+
+
+    def _refill(self):
+        now = asyncio.get_running_loop().time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+    async def acquire(self):
+        # Callers reserve a token right away and sleep until it is due, so they are served in arrival order
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class PriorityGate:
+    """
+    Semaphore handing free slots to the waiter with the highest priority (lowest value) first.
+    """
+
+    def __init__(self, limit: int):
+        self.free = limit
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+
+    async def acquire(self, priority: int):
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release() # slot was handed over already
+            raise
+
+
+    def release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.free += 1
+
+
+class TelegramRateLimiter(BaseRateLimiter[dict]):
+    """
+    Central throttle for every Bot API request of the application.
+    Requests addressed to a chat pass a global token bucket and a bounded number of them run at once,
+    interactive ones before broadcasts, which also pass a per-chat token bucket. RetryAfter pauses all chat requests and the request is retried.
+    Pass rate_limit_args=BROADCAST for scheduled deliveries.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, max_concurrent: int = MAX_CONCURRENT_REQUESTS, max_retries: int = MAX_RETRIES):
+        self.global_rate = global_rate
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self._global: TokenBucket = None
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._gate: PriorityGate = None
+        self._resume_at = 0.0
+
+
+    async def initialize(self):
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        self._gate = PriorityGate(self.max_concurrent)
+
+
+    async def shutdown(self):
+        self._chats.clear()
+
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_IDLE_CHAT_BUCKETS:
+                self._chats = {chat: b for chat, b in self._chats.items() if not b.idle}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(GROUP_CHAT_RATE if is_group else PRIVATE_CHAT_RATE, CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+
+    async def _wait_for_flood_control(self):
+        loop = asyncio.get_running_loop()
+        while (delay := self._resume_at - loop.time()) > 0:
+            await asyncio.sleep(delay)
+
+
+    async def process_request(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any, kwargs: dict[str, Any],
+                              endpoint: str, data: dict[str, Any], rate_limit_args: dict | None) -> Any:
+        chat_id = data.get('chat_id')
+        priority = (rate_limit_args or {}).get('priority', Priority.INTERACTIVE)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                if chat_id is None:
+                    # getUpdates, answerCallbackQuery etc. do not count towards message limits
+                    return await callback(*args, **kwargs)
+
+                if priority == Priority.BROADCAST:
+                    # Replies and edits follow the user's own pace, only deliveries are spread out per chat
+                    await self._chat_bucket(chat_id).acquire()
+                await self._gate.acquire(priority)
+                try:
+                    await self._wait_for_flood_control()
+                    await self._global.acquire()
+                    with SEND_SECONDS.time(endpoint):
+                        return await callback(*args, **kwargs)
+                finally:
+                    self._gate.release()
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logger.warning(f'Flood control on {endpoint} for chat {chat_id}, retrying in {retry_after}s')
+                loop = asyncio.get_running_loop()
+                self._resume_at = max(self._resume_at, loop.time() + retry_after)
+                await self._wait_for_flood_control()
@@ -0,0 +1,159 @@
+import time
+import asyncio
+import logging
+import pathlib
+from types import SimpleNamespace
+from datetime import datetime, timezone, timedelta
+
+from telegram.ext import Application, CallbackContext
+
+from .jobs import JobTypes, RenderedExercise
+from .exercise_store import Exercise
+from .shared_exercises import SharedExercises
+from .metrics import JOB_LAG_SECONDS, DELIVERIES, DELIVERY_FAILURES
+from .sub_storage import SubInfo, MINUTES_PER_DAY
+
+
+logger = logging.getLogger(__name__)
+
+MAX_CATCH_UP_MINUTES = 10 # minutes missed by a delayed tick that are still delivered
+MAX_CONCURRENT_DELIVERIES = 64
+DELIVERY_TIMEOUT = 15 * 60 # seconds after which a delivery is dropped, cancelling its pending encodes
+
+
+class DeliveryScheduler:
+    """
+    Index from UTC minute of the day to the subscriptions due at that minute.
+    A single job ticks every minute and fans out to everything due, instead of one daily job per subscription.
+    """
+
+    def __init__(self, app: Application, data_dir: pathlib.Path, jobs: dict, preparers: dict, shared: SharedExercises = None,
+                 tick_path: pathlib.Path = None):
+        """
+        :param tick_path: file the last processed minute is kept in across restarts, data_dir/last_tick by default
+        """
+        self.app = app
+        self.data_dir = data_dir
+        self.jobs = jobs
+        self.preparers = preparers
+        self.shared = shared # deliver one exercise to every subscriber of a cohort if set
+        self.buckets: dict[int, dict[tuple[int, str, str], SubInfo]] = {}
+        self.tick_path = tick_path or data_dir / 'last_tick'
+        self._last_minute: int = self._load_last_minute() # minutes since epoch of the last processed tick
+        self._deliveries = asyncio.Semaphore(MAX_CONCURRENT_DELIVERIES)
+
+        next_minute = datetime.now(timezone.utc).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        self.app.job_queue.run_repeating(self._tick, interval=60, first=next_minute, name='delivery_tick')
+
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+
+    def add(self, chat_id: int, info: SubInfo):
+        logger.debug(f'Scheduling {info.task} for chat {chat_id} at {info.hour}:{info.minute:02d} GMT{info.timezone:+}')
+        self.buckets.setdefault(info.utc_minute, {})[(chat_id, info.task, info.lang)] = info
+
+
+    def add_many(self, subs: list[tuple[int, SubInfo]]):
+        """
+        Bulk add on startup, without a log line per subscription.
+        """
+        for chat_id, info in subs:
+            self.buckets.setdefault(info.utc_minute, {})[(chat_id, info.task, info.lang)] = info
+
+
+    def remove(self, chat_id: int, info: SubInfo):
+        bucket = self.buckets.get(info.utc_minute, {})
+        bucket.pop((chat_id, info.task, info.lang), None)
+        if not bucket:
+            self.buckets.pop(info.utc_minute, None)
+
+
+    def due(self, minute_of_day: int) -> list[tuple[int, SubInfo]]:
+        return [(chat_id, info) for (chat_id, _, _), info in self.buckets.get(minute_of_day, {}).items()]
+
+
+    def _load_last_minute(self) -> int | None:
+        try:
+            return int(self.tick_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+
+
+    def _save_last_minute(self):
+        tmp = self.tick_path.with_suffix('.tmp')
+        try:
+            tmp.write_text(str(self._last_minute), encoding='utf-8')
+            tmp.replace(self.tick_path)
+        except OSError as e:
+            logger.error(f'Failed to save the last delivery minute: {e}')
+
+
+    async def _tick(self, context: CallbackContext):
+        # A minute processed before a restart is not delivered again, the ones missed meanwhile are caught up
+        now = int(time.time() // 60)
+        first = now if self._last_minute is None else max(self._last_minute + 1, now - MAX_CATCH_UP_MINUTES)
+        self._last_minute = max(now, self._last_minute or now)
+        self._save_last_minute()
+
+        due = [item for minute in range(first, now + 1) for item in self.due(minute % MINUTES_PER_DAY)]
+        if due:
+            logger.info(f'Delivering {len(due)} subscriptions')
+            # Run in the background so a long fan-out does not block the next tick
+            self.app.create_task(self.deliver(due))
+
+
+    async def deliver(self, due: list[tuple[int, SubInfo]]):
+        # Exercises are prepared per (task, language, minute) group so the group shares file reads and clip renders
+        groups: dict[tuple[str, str, int], list[int]] = {}
+        for chat_id, info in due:
+            groups.setdefault((info.task, info.lang, info.utc_minute), []).append(chat_id)
+
+        deliveries = []
+        for (task, lang, utc_minute), chat_ids in groups.items():
+            try:
+                if self.shared is not None:
+                    exercises = [await self.shared.get(task, lang, utc_minute)] * len(chat_ids)
+                else:
+                    exercises = [(exercise, None) for exercise in await self.preparers[JobTypes(task)](self.data_dir, lang, len(chat_ids))]
+            except Exception as e:
+                logger.error(f'Failed to prepare {task} ({lang}) for {len(chat_ids)} chats: {e}')
+                exercises = [(None, None)] * len(chat_ids)
+            deliveries.extend(self._deliver_one(chat_id, task, lang, utc_minute, exercise, rendered)
+                              for chat_id, (exercise, rendered) in zip(chat_ids, exercises))
+
+        await asyncio.gather(*deliveries)
+
+
+    async def _deliver_one(self, chat_id: int, task: str, lang: str, utc_minute: int, exercise: Exercise | None,
+                           rendered: RenderedExercise | None):
+        context = SimpleNamespace(
+            bot=self.app.bot,
+            bot_data=self.app.bot_data,
+            job=SimpleNamespace(chat_id=chat_id, data={
+                'chat_id': chat_id,
+                'data_dir': self.data_dir,
+                'language': lang,
+                'exercise': exercise,
+                'rendered': rendered,
+            }),
+        )
+        async with self._deliveries:
+            JOB_LAG_SECONDS.observe(_seconds_since(utc_minute), task)
+            try:
+                await asyncio.wait_for(self.jobs[JobTypes(task)](context), DELIVERY_TIMEOUT)
+                DELIVERIES.inc(task, lang)
+            except asyncio.TimeoutError:
+                DELIVERY_FAILURES.inc(task, lang)
+                logger.error(f'Dropped {task} ({lang}) delivery to chat {chat_id} after {DELIVERY_TIMEOUT}s')
+            except Exception as e:
+                DELIVERY_FAILURES.inc(task, lang)
+                logger.exception(f'Failed to deliver {task} ({lang}) to chat {chat_id}: {e}')
+
+
+def _seconds_since(utc_minute: int) -> float:
+    """
+    Seconds since the last time the UTC minute of the day started.
+    """
+    return (time.time() - utc_minute * 60) % (MINUTES_PER_DAY * 60)
@@ -0,0 +1,29 @@
+from dataclasses import dataclass
+
+
+# Option values are kept here, so the command line is checked without importing the bot
+STORAGE_NAMES = ('json', 'sqlite') # keys of sub_storage.STORAGES
+SHARED_MODES = ('off', 'day', 'slot')
+
+
+@dataclass
+class Settings:
+    """
+    Runtime options of the bot, filled from the command line (see __main__).
+    """
+    storage: str = 'json' # subscriptions backend, one of STORAGE_NAMES
+    shared_exercises: str = 'off' # 'day'/'slot' sends one exercise per task, language and day/delivery minute to everyone
+    shards: int = 0 # delivery worker processes, each owning the subscriptions of a range of chats; 0 delivers in the main process
+    concurrent_updates: int = 32 # updates of different chats processed at once, 1 processes all updates sequentially
+
+    # Updates are long polled unless webhook_url is set; polling removes a previously set webhook on start
+    webhook_url: str = None # public URL Telegram posts updates to, usually a reverse proxy in front of the listener
+    webhook_listen: str = '127.0.0.1' # local address of the webhook listener
+    webhook_port: int = 8443
+    webhook_path: str = 'telegram' # URL path the listener accepts updates on
+    webhook_max_connections: int = 40 # simultaneous connections Telegram opens to deliver updates (1-100)
+    api_url: str = None # Bot API server, e.g. a local Bot API server or a stand-in for tests (default: Telegram)
+    metrics_port: int = None # serve Prometheus metrics at /metrics on this port, delivery shards use the following ports
+    metrics_listen: str = '127.0.0.1'
+    profile_threshold: float = None # seconds after which a conversation step or delivery job is reported to data_dir/profiles
+    profile_sample_rate: float = 0.1 # share of invocations run under cProfile while profiling
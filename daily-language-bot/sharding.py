@@ -0,0 +1,288 @@
+import zlib
+import queue
+import asyncio
+import logging
+import pathlib
+import threading
+import multiprocessing
+from dataclasses import asdict
+from multiprocessing.connection import Connection
+
+from telegram.ext import Application, ApplicationBuilder, CallbackContext
+
+from .settings import Settings
+from .metrics import MetricsServer, SCHEDULED
+from .profiling import enable_profiling
+from .rate_limiter import TelegramRateLimiter, GLOBAL_RATE
+from .scheduler import DeliveryScheduler
+from .shared_exercises import SharedExercises
+from .sub_manager import SubManager
+from .sub_storage import SubInfo
+from .exercise_store import Exercise, ExerciseStore, set_exercise_store
+from .file_id_cache import FileIdCache, set_file_id_cache
+
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CHECK_INTERVAL = 10 # seconds between checks for crashed workers
+STOP_TIMEOUT = 10 # seconds a worker gets to finish its deliveries on shutdown
+ADD_MANY_CHUNK = 2000 # subscriptions per message to a worker, keeps single pipe writes small
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    """
+    Shard owning a chat: the 32-bit hash space of chat ids is split into equal ranges.
+    """
+    return zlib.crc32(chat_id.to_bytes(8, 'little', signed=True)) * shards >> 32
+
+
+class PipeWriter:
+    """
+    Sends messages over a pipe in order from a thread of its own:
+    a full pipe blocks that thread instead of the event loop, which goes on reading the other direction.
+    """
+
+    def __init__(self, conn: Connection, name: str):
+        self.conn = conn
+        self._queue: queue.SimpleQueue[tuple | None] = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+
+    def send(self, message: tuple):
+        self._queue.put(message)
+
+
+    def close(self):
+        """
+        Stop the thread once the messages sent before are written.
+        """
+        self._queue.put(None)
+
+
+    def join(self, timeout: float = None):
+        self._thread.join(timeout)
+
+
+    def _run(self):
+        while (message := self._queue.get()) is not None:
+            try:
+                self.conn.send(message)
+            except OSError as e:
+                logger.error(f'{self._thread.name} failed to write: {e}')
+                return
+
+
+class ShardPool:
+    """
+    Coordinator side of the sharded runtime, used by SubManager in place of a DeliveryScheduler.
+    Each worker process schedules and renders the deliveries of its shard of chats;
+    subscription changes are sent to the owning worker over a pipe, exercises sent by workers come back over it.
+    A worker that dies is restarted with the current subscriptions of its shard.
+    """
+
+    def __init__(self, data_dir: pathlib.Path, settings: Settings, exercises: ExerciseStore):
+        self.data_dir = data_dir
+        self.settings = settings
+        self.shards = settings.shards
+        self.exercises = exercises
+        self.subs: list[dict[tuple[int, str, str], SubInfo]] = [{} for _ in range(self.shards)]
+        self._processes: list[multiprocessing.Process | None] = [None] * self.shards
+        self._conns: list[Connection | None] = [None] * self.shards
+        self._writers: list[PipeWriter | None] = [None] * self.shards
+        self._mp = multiprocessing.get_context('spawn')
+        self._app: Application = None
+
+
+    def __len__(self):
+        return sum(len(subs) for subs in self.subs)
+
+
+    def add(self, chat_id: int, info: SubInfo):
+        shard = shard_of(chat_id, self.shards)
+        self.subs[shard][(chat_id, info.task, info.lang)] = info
+        self._send(shard, ('add', chat_id, asdict(info)))
+
+
+    def add_many(self, subs: list[tuple[int, SubInfo]]):
+        batches: list[list[tuple[int, dict]]] = [[] for _ in range(self.shards)]
+        for chat_id, info in subs:
+            shard = shard_of(chat_id, self.shards)
+            self.subs[shard][(chat_id, info.task, info.lang)] = info
+            batches[shard].append((chat_id, asdict(info)))
+        for shard, batch in enumerate(batches):
+            for start in range(0, len(batch), ADD_MANY_CHUNK):
+                self._send(shard, ('add_many', None, batch[start:start + ADD_MANY_CHUNK]))
+
+
+    def remove(self, chat_id: int, info: SubInfo):
+        shard = shard_of(chat_id, self.shards)
+        self.subs[shard].pop((chat_id, info.task, info.lang), None)
+        self._send(shard, ('remove', chat_id, asdict(info)))
+
+
+    def _send(self, shard: int, message: tuple):
+        # Before start the subscriptions are handed to the worker on spawn,
+        # a worker that dies loses the messages not written yet and gets the changes when restarted
+        writer = self._writers[shard]
+        if writer is not None:
+            writer.send(message)
+
+
+    def start(self, app: Application):
+        self._app = app
+        for shard in range(self.shards):
+            self._spawn(shard)
+        app.job_queue.run_repeating(self._health_check, interval=HEALTH_CHECK_INTERVAL, name='shard_health_check')
+        logger.info(f'Started {self.shards} delivery shards for {len(self)} subscriptions')
+
+
+    def _spawn(self, shard: int):
+        conn, child_conn = self._mp.Pipe()
+        subs = [(chat_id, asdict(info)) for (chat_id, _, _), info in self.subs[shard].items()]
+        process = self._mp.Process(target=run_shard, name=f'shard-{shard}', daemon=True,
+                                   args=(self.data_dir, self.settings, shard, subs, child_conn))
+        process.start()
+        child_conn.close()
+        self._processes[shard], self._conns[shard] = process, conn
+        self._writers[shard] = PipeWriter(conn, f'shard-{shard}-writer')
+        asyncio.get_running_loop().add_reader(conn.fileno(), self._receive, shard)
+
+
+    def _close(self, shard: int):
+        conn = self._conns[shard]
+        asyncio.get_running_loop().remove_reader(conn.fileno())
+        self._writers[shard].close()
+        conn.close()
+        self._conns[shard], self._writers[shard] = None, None
+
+
+    def _receive(self, shard: int):
+        conn = self._conns[shard]
+        try:
+            while conn.poll():
+                op, chat_id, raw = conn.recv()
+                if op == 'exercise':
+                    self.exercises.put(chat_id, Exercise.from_json(raw))
+        except (EOFError, OSError):
+            # Worker exited, the health check restarts it
+            self._close(shard)
+
+
+    async def _health_check(self, context: CallbackContext):
+        for shard, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error(f'Shard {shard} exited with code {process.exitcode}, restarting it')
+                if self._conns[shard] is not None:
+                    self._close(shard)
+                self._spawn(shard)
+
+
+    async def stop(self):
+        for shard in range(self.shards):
+            self._send(shard, ('stop', None, None))
+        for shard, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f'Shard {shard} did not stop in time, terminating it')
+                process.terminate()
+            if self._conns[shard] is not None:
+                self._receive(shard) # exercises sent right before stopping
+                if self._conns[shard] is not None:
+                    self._close(shard)
+        self._processes = [None] * self.shards
+
+
+class ForwardingExercises:
+    """
+    Exercise store of a worker: exercises are recorded by the coordinator, which checks the answers.
+    """
+
+    def __init__(self, writer: PipeWriter):
+        self.writer = writer
+
+
+    def put(self, chat_id: int, exercise: Exercise):
+        self.writer.send(('exercise', chat_id, exercise.to_json()))
+
+
+def run_shard(data_dir: pathlib.Path, settings: Settings, shard: int, subs: list[tuple[int, dict]], conn: Connection):
+    """
+    Entry point of a worker process.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s | %(levelname)-8s | shard {shard} | %(name)s | %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+    )
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('httpcore').setLevel(logging.WARNING)
+    try:
+        asyncio.run(_serve_shard(data_dir, settings, shard, subs, conn))
+    except KeyboardInterrupt:
+        pass # the coordinator stops the workers itself
+
+
+async def _serve_shard(data_dir: pathlib.Path, settings: Settings, shard: int, subs: list[tuple[int, dict]], conn: Connection):
+    with open(data_dir / 'token', 'r', encoding='utf-8') as f:
+        # Chats are split between the workers, the global message rate has to be split as well
+        builder = (ApplicationBuilder()
+                   .token(f.read().strip())
+                   .updater(None)
+                   .rate_limiter(TelegramRateLimiter(global_rate=GLOBAL_RATE / settings.shards)))
+    if settings.api_url:
+        api_url = settings.api_url.rstrip('/')
+        builder = builder.base_url(f'{api_url}/bot').base_file_url(f'{api_url}/file/bot')
+    app = builder.build()
+    writer = PipeWriter(conn, f'shard-{shard}-writer')
+    set_exercise_store(data_dir, ForwardingExercises(writer))
+    # Every worker appends to and compacts its own log, the file ids are valid for the whole bot
+    set_file_id_cache(data_dir, FileIdCache(data_dir / f'file_ids.{shard}.jsonl'))
+    if settings.profile_threshold is not None:
+        enable_profiling(data_dir, settings.profile_threshold, settings.profile_sample_rate)
+
+    stopped = asyncio.Event()
+
+    def receive():
+        try:
+            while conn.poll():
+                op, chat_id, raw = conn.recv()
+                if op == 'add':
+                    scheduler.add(chat_id, SubInfo(**raw))
+                elif op == 'add_many':
+                    scheduler.add_many([(chat_id, SubInfo(**info)) for chat_id, info in raw])
+                elif op == 'remove':
+                    scheduler.remove(chat_id, SubInfo(**raw))
+                elif op == 'stop':
+                    stopped.set()
+        except (EOFError, OSError):
+            logger.error('Lost the coordinator, stopping')
+            stopped.set()
+
+    async with app:
+        await app.start()
+        shared = None
+        if settings.shared_exercises != 'off':
+            shared = SharedExercises(data_dir, SubManager.PREPARERS, SubManager.RENDERERS, settings.shared_exercises)
+        scheduler = DeliveryScheduler(app, data_dir, SubManager.JOBS, SubManager.PREPARERS, shared,
+                                       tick_path=data_dir / f'last_tick.{shard}')
+        scheduler.add_many([(chat_id, SubInfo(**raw)) for chat_id, raw in subs])
+        logger.info(f'Shard {shard} scheduling {len(scheduler)} subscriptions')
+        # Deliveries are measured where they run: every shard serves its own metrics next to the coordinator's port
+        metrics = MetricsServer(settings.metrics_listen, settings.metrics_port + 1 + shard) if settings.metrics_port else None
+        SCHEDULED.set_function(lambda: len(scheduler))
+        if metrics is not None:
+            await metrics.start()
+
+        asyncio.get_running_loop().add_reader(conn.fileno(), receive)
+        await stopped.wait()
+        asyncio.get_running_loop().remove_reader(conn.fileno())
+        if metrics is not None:
+            await metrics.stop()
+        await app.stop()
+    # Exercises sent last are still recorded by the coordinator, which reads until the worker has exited
+    writer.close()
+    await asyncio.to_thread(writer.join, STOP_TIMEOUT)
+    conn.close()
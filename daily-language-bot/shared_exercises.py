@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import pathlib
+from datetime import datetime, timezone
+
+from .jobs import JobTypes, RenderedExercise
+from .exercise_store import Exercise
+from .settings import SHARED_MODES
+
+
+logger = logging.getLogger(__name__)
+
+
+class SharedExercises:
+    """
+    One exercise per (task, language, day) - or per delivery minute in 'slot' mode -
+    generated and rendered once and delivered to every subscriber of that cohort.
+    """
+
+    def __init__(self, data_dir: pathlib.Path, preparers: dict, renderers: dict, mode: str = 'day'):
+        assert mode in SHARED_MODES[1:]
+        self.data_dir = data_dir
+        self.preparers = preparers
+        self.renderers = renderers
+        self.mode = mode
+        self._exercises: dict[tuple, asyncio.Future] = {}
+
+
+    def _key(self, task: str, lang: str, utc_minute: int) -> tuple:
+        day = datetime.now(timezone.utc).date().isoformat()
+        return (task, lang, day, utc_minute) if self.mode == 'slot' else (task, lang, day)
+
+
+    async def get(self, task: str, lang: str, utc_minute: int) -> tuple[Exercise, RenderedExercise]:
+        key = self._key(task, lang, utc_minute)
+        exercise = self._exercises.get(key)
+        if exercise is None or (exercise.done() and exercise.exception() is not None):
+            # Exercises of previous days are not needed anymore
+            day = key[2]
+            self._exercises = {k: v for k, v in self._exercises.items() if k[2] == day}
+            exercise = asyncio.ensure_future(self._create(key))
+            self._exercises[key] = exercise
+        return await asyncio.shield(exercise)
+
+
+    async def _create(self, key: tuple) -> tuple[Exercise, RenderedExercise]:
+        task, lang = key[:2]
+        logger.info(f'Creating shared {task} exercise ({lang})')
+        shared_key = '/'.join(map(str, key))
+        # Seeded by the key, so every process delivering this cohort comes up with the same exercise
+        exercise, = await self.preparers[JobTypes(task)](self.data_dir, lang, 1, seed=shared_key)
+        exercise.shared_key = shared_key
+        rendered = await self.renderers[JobTypes(task)](self.data_dir, exercise)
+        return exercise, rendered
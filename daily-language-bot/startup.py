@@ -0,0 +1,38 @@
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """
+    Durations of the startup phases, logged in one line once the bot is ready for updates.
+    """
+
+    def __init__(self, started: float = None):
+        """
+        :param started: time.perf_counter() value the startup began at, now by default
+        """
+        self.started = started if started is not None else time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+        self._last = self.started
+
+
+    def mark(self, phase: str):
+        """
+        Record that phase has just finished.
+        """
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+    def report(self):
+        phases = ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.phases)
+        logger.info(f'Ready for updates {self.elapsed:.2f}s after start ({phases})')
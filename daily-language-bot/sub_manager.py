@@ -1,138 +1,142 @@
-import json
+import time
+import asyncio
 import pathlib
 import logging
-from dataclasses import dataclass, asdict
-from datetime import time, timezone, timedelta
+from datetime import datetime, timezone
 
 from telegram.ext import CallbackContext
 
 from .jobs import *
+from .scheduler import DeliveryScheduler
+from .shared_exercises import SharedExercises
+from .sub_storage import SubInfo, SubStorage, JournalStorage, MINUTES_PER_DAY
+from .metrics import STORAGE_SECONDS
+from .profiling import profiled_job
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
-class SubInfo:
-    task: str
-    lang: str
-    hour: int
-    minute: int
-    timezone: int # in format +2/-3
-
-
 class SubManager:
+    """
+    Subscriptions of all chats and their delivery schedule.
+    Persistence is delegated to a SubStorage backend (JSON journal by default).
+    """
 
     JOBS = {
-        JobTypes.NUMBERS: send_daily_numbers,
-        JobTypes.VERBS: send_daily_verbs
+        JobTypes.NUMBERS: profiled_job(send_daily_numbers),
+        JobTypes.VERBS: profiled_job(send_daily_verbs)
+    }
+
+    # Batch exercise generation for all deliveries of a task due at the same minute
+    PREPARERS = {
+        JobTypes.NUMBERS: prepare_daily_numbers,
+        JobTypes.VERBS: prepare_daily_verbs
     }
 
-    def __init__(self, data_dir: pathlib.Path, context: CallbackContext):
+    RENDERERS = {
+        JobTypes.NUMBERS: render_daily_numbers,
+        JobTypes.VERBS: render_daily_verbs
+    }
+
+    COMPACT_INTERVAL = 600 # seconds
+    COMPACT_THRESHOLD = 1000 # pending storage records triggering an early compaction
+    EAGER_RESTORE_MINUTES = 3 * 60 # deliveries registered before the bot starts, the rest of the day follows in the background
+    RESTORE_CHUNK_MINUTES = 60 # deliveries registered per step of the background restore
+
+    def __init__(self, data_dir: pathlib.Path, context: CallbackContext, storage: SubStorage = None, shared_exercises: str = 'off',
+                 scheduler=None):
+        """
+        :param scheduler: delivers the subscriptions, a DeliveryScheduler in this process by default (see sharding.ShardPool)
+        """
         self.data_dir = data_dir
-        self.storage_path = data_dir / 'subs.json'
-        self.data: dict[int, list[SubInfo]] = {}
+        self.storage = storage or JournalStorage(data_dir)
         self.ctx = context
-        self._load()
+        if scheduler is None:
+            shared = None if shared_exercises == 'off' else SharedExercises(data_dir, self.PREPARERS, self.RENDERERS, shared_exercises)
+            scheduler = DeliveryScheduler(self.ctx, data_dir, self.JOBS, self.PREPARERS, shared)
+        self.scheduler = scheduler
+        self.ctx.job_queue.run_repeating(self._compact_job, interval=self.COMPACT_INTERVAL, first=self.COMPACT_INTERVAL)
         self._restore_subs()
 
 
+    def _due_within(self, first_minute: int, minutes: int) -> list[tuple[int, SubInfo]]:
+        """
+        Subscriptions due in the given number of minutes from first_minute (UTC minute of the day), across midnight.
+        """
+        last_minute = first_minute + minutes - 1
+        subs = self.storage.due(first_minute, min(last_minute, MINUTES_PER_DAY - 1))
+        if last_minute >= MINUTES_PER_DAY:
+            subs += self.storage.due(0, last_minute - MINUTES_PER_DAY)
+        return subs
+
+
     def _restore_subs(self):
-        for chat_id, subs in self.data.items():
-            for sub_info in subs:
-                logger.info(f'Restoring subscription for {chat_id} to {sub_info.task} at {sub_info.hour}:{sub_info.minute:02d} GMT{sub_info.timezone:+}')
-                self._schedule_daily_job(chat_id, sub_info)
-
-    def _load(self):
-        if not self.storage_path.exists():
-            logger.info(f'Creating new storage at {self.storage_path}')
-            self._save()
-            return {}
-
-        with open(self.storage_path, 'r', encoding='utf-8') as f:
-            raw_data = json.load(f)
-            for chat_id, subs in raw_data.items():
-                self.data[int(chat_id)] = []
-                for sub_info in subs:
-                    self.data[int(chat_id)].append(SubInfo(*sub_info.values()))
-            logger.debug(f'Loaded storage {self.data}')
-
-
-    def _save(self):
-        raw_data = {}
-        for chat_id, subs in self.data.items():
-            raw_data[str(chat_id)] = []
-            for sub_info in subs:
-                raw_data[str(chat_id)].append(asdict(sub_info))
-        tmp = self.storage_path.with_suffix('.tmp')
-        with open(tmp, 'w', encoding='utf-8') as f:
-            json.dump(raw_data, f, indent=4)
-        tmp.replace(self.storage_path)
+        now = datetime.now(timezone.utc)
+        first_minute = now.hour * 60 + now.minute
+        with STORAGE_SECONDS.time('restore'):
+            subs = self._due_within(first_minute, self.EAGER_RESTORE_MINUTES)
+            self.scheduler.add_many(subs)
+        logger.info(f'Restored {len(subs)} subscriptions due in the next {self.EAGER_RESTORE_MINUTES // 60} hours')
+        self.ctx.job_queue.run_once(self._restore_rest_job, when=0, data=first_minute + self.EAGER_RESTORE_MINUTES,
+                                    name='restore_subs')
 
 
-    def add_sub(self, chat_id: int, info: SubInfo):
-        self._load()
-        if chat_id not in self.data:
-            self.data[chat_id] = [info]
-        else:
-            self.data[chat_id].append(info)
-        self._save()
-        self._schedule_daily_job(chat_id, info)
+    async def _restore_rest_job(self, context: CallbackContext):
+        # Each step reads the storage and registers in one go, so a subscription changed meanwhile is never restored stale
+        start = time.perf_counter()
+        count = 0
+        first_minute = context.job.data
+        remaining = MINUTES_PER_DAY - self.EAGER_RESTORE_MINUTES
+        for offset in range(0, remaining, self.RESTORE_CHUNK_MINUTES):
+            subs = self._due_within((first_minute + offset) % MINUTES_PER_DAY, min(self.RESTORE_CHUNK_MINUTES, remaining - offset))
+            self.scheduler.add_many(subs)
+            count += len(subs)
+            await asyncio.sleep(0) # let updates through between the steps
+        logger.info(f'Restored the remaining {count} subscriptions in {time.perf_counter() - start:.2f}s')
+
+
+    async def _compact_job(self, context: CallbackContext):
+        with STORAGE_SECONDS.time('compact'):
+            await self.storage.compact()
 
 
+    def _after_mutation(self):
+        if self.storage.pending_records == self.COMPACT_THRESHOLD:
+            self.ctx.job_queue.run_once(self._compact_job, when=0)
 
-    def _schedule_daily_job(self, chat_id: int, info: SubInfo):
+
+    def add_sub(self, chat_id: int, info: SubInfo):
+        with STORAGE_SECONDS.time('add'):
+            self.storage.add(chat_id, info)
+        self._after_mutation()
         logger.info(f'Scheduling job {info.task} for chat {chat_id} at {info.hour}:{info.minute:02d} GMT{info.timezone:+}')
-        self.ctx.job_queue.run_daily(
-            self.JOBS[JobTypes(info.task)],
-            time=time(hour=info.hour, minute=info.minute, tzinfo=timezone(timedelta(hours=info.timezone))),
-            name=f'{info.task}_{info.lang}_{chat_id}',
-            chat_id=chat_id,
-            data={'chat_id': chat_id, 'data_dir': self.data_dir, 'language': info.lang },
-        )
+        self.scheduler.add(chat_id, info)
+
 
     def remove_subs(self, chat_id: int):
-        self._load()
-        subs = self.data.pop(chat_id)
+        with STORAGE_SECONDS.time('remove'):
+            subs = self.storage.remove_all(chat_id)
+        self._after_mutation()
         for sub_info in subs:
-            for job in self.ctx.job_queue.get_jobs_by_name(f'{sub_info.task}_{sub_info.lang}_{chat_id}'):
-                job.schedule_removal()
-        self._save()
+            self.scheduler.remove(chat_id, sub_info)
 
 
     def remove_sub(self, chat_id: int, task: str) -> SubInfo:
-        self._load()
-        subs = self.data[chat_id]
-        save = None
-        for i, sub in enumerate(subs):
-            if sub.task == task:
-                save = subs.pop(i)
-                break
-        self._save()
-        for job in self.ctx.job_queue.get_jobs_by_name(f'{save.task}_{save.lang}_{chat_id}'):
-            job.schedule_removal()
+        with STORAGE_SECONDS.time('remove'):
+            save = self.storage.remove(chat_id, task)
+        self._after_mutation()
+        self.scheduler.remove(chat_id, save)
         return save
 
 
     def has_sub(self, chat_id: int, task: str, lang: str) -> bool:
-        self._load()
-        if chat_id not in self.data:
-            return False
-        subs = self.data[chat_id]
-        for sub in subs:
-            if sub.task == task and sub.lang == lang:
-                return True
-
-        return False
+        return self.storage.has(chat_id, task, lang)
 
 
     def get_subs(self, chat_id: int) -> list[SubInfo]:
-        self._load()
-        if len(self.data) == 0 or chat_id not in self.data:
-            return []
-        return self.data[chat_id]
+        return self.storage.get(chat_id)
 
 
     @property
     def subs(self) -> dict[int, list[SubInfo]]:
-        self._load()
-        return self.data
+        return self.storage.all()
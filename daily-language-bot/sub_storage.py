@@ -0,0 +1,392 @@
+import os
+import json
+import shutil
+import sqlite3
+import asyncio
+import pathlib
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, asdict
+
+from .metrics import STORAGE_SECONDS
+from .settings import STORAGE_NAMES
+
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+
+
+@dataclass
+class SubInfo:
+    task: str
+    lang: str
+    hour: int
+    minute: int
+    timezone: int # in format +2/-3
+
+    @property
+    def utc_minute(self) -> int:
+        """
+        Delivery time as minute of the day in UTC
+        """
+        return ((self.hour - self.timezone) * 60 + self.minute) % MINUTES_PER_DAY
+
+
+class SubStorage(ABC):
+    """
+    Storage backend interface of SubManager.
+    """
+
+    # Mutations not yet compacted, SubManager compacts early once it reaches COMPACT_THRESHOLD
+    pending_records = 0
+
+    @abstractmethod
+    def all(self) -> dict[int, list[SubInfo]]:
+        ...
+
+    @abstractmethod
+    def get(self, chat_id: int) -> list[SubInfo]:
+        ...
+
+    @abstractmethod
+    def has(self, chat_id: int, task: str, lang: str) -> bool:
+        ...
+
+    @abstractmethod
+    def due(self, first_minute: int, last_minute: int) -> list[tuple[int, SubInfo]]:
+        """
+        Subscriptions delivered between the given UTC minutes of the day, both inclusive.
+        """
+
+    @abstractmethod
+    def add(self, chat_id: int, info: SubInfo):
+        ...
+
+    @abstractmethod
+    def remove(self, chat_id: int, task: str) -> SubInfo | None:
+        ...
+
+    @abstractmethod
+    def remove_all(self, chat_id: int) -> list[SubInfo]:
+        ...
+
+    async def compact(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JournalStorage(SubStorage):
+    """
+    The in-memory dict is the source of truth:
+    every mutation is appended to an fsync'd journal, which is compacted into the subs.json snapshot.
+    """
+
+    def __init__(self, data_dir: pathlib.Path):
+        self.storage_path = data_dir / 'subs.json'
+        self.journal_path = data_dir / 'subs.journal'
+        self.old_journal_path = data_dir / 'subs.journal.old' # journal being compacted
+        self.data: dict[int, list[SubInfo]] = {}
+        self._minutes: dict[int, dict[int, tuple[int, SubInfo]]] = {} # UTC minute -> id(sub) -> (chat_id, sub)
+        self._seq = 0 # sequence number of the last applied mutation
+        self._compacting = False
+        self._load()
+        if self.pending_records:
+            self._compact()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+
+    def _load(self):
+        if not self.storage_path.exists():
+            logger.info(f'Creating new storage at {self.storage_path}')
+            self._write_snapshot(self._snapshot())
+        else:
+            with open(self.storage_path, 'r', encoding='utf-8') as f:
+                raw_data = json.load(f)
+            if 'subs' not in raw_data:
+                raw_data = {'seq': 0, 'subs': raw_data} # legacy snapshot without journal
+            self._seq = raw_data['seq']
+            for chat_id, subs in raw_data['subs'].items():
+                self.data[int(chat_id)] = [SubInfo(**sub_info) for sub_info in subs]
+                for sub in self.data[int(chat_id)]:
+                    self._index(int(chat_id), sub)
+
+        # Replay mutations made after the snapshot
+        for journal_path in (self.old_journal_path, self.journal_path):
+            if not journal_path.exists():
+                continue
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f'Skipping torn journal record in {journal_path}')
+                        continue
+                    if record['seq'] <= self._seq:
+                        continue
+                    self._apply(record)
+                    self._seq = record['seq']
+                    self.pending_records += 1
+        logger.debug(f'Loaded {len(self.data)} chats from {self.storage_path}')
+
+
+    def _index(self, chat_id: int, sub: SubInfo):
+        self._minutes.setdefault(sub.utc_minute, {})[id(sub)] = (chat_id, sub)
+
+
+    def _unindex(self, sub: SubInfo):
+        minute = self._minutes.get(sub.utc_minute, {})
+        minute.pop(id(sub), None)
+        if not minute:
+            self._minutes.pop(sub.utc_minute, None)
+
+
+    def _apply(self, record: dict) -> SubInfo | list[SubInfo] | None:
+        chat_id = record['chat_id']
+        if record['op'] == 'add':
+            sub = SubInfo(**record['sub'])
+            self.data.setdefault(chat_id, []).append(sub)
+            self._index(chat_id, sub)
+        elif record['op'] == 'remove':
+            subs = self.data.get(chat_id, [])
+            for i, sub in enumerate(subs):
+                if sub.task == record['task']:
+                    self._unindex(sub)
+                    return subs.pop(i)
+        elif record['op'] == 'remove_all':
+            subs = self.data.pop(chat_id, [])
+            for sub in subs:
+                self._unindex(sub)
+            return subs
+        return None
+
+
+    def _commit(self, record: dict) -> SubInfo | list[SubInfo] | None:
+        self._seq += 1
+        record['seq'] = self._seq
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.pending_records += 1
+        return self._apply(record)
+
+
+    def _snapshot(self) -> dict:
+        raw_data = {}
+        for chat_id, subs in self.data.items():
+            raw_data[str(chat_id)] = []
+            for sub_info in subs:
+                raw_data[str(chat_id)].append(asdict(sub_info))
+        return {'seq': self._seq, 'subs': raw_data}
+
+
+    def _write_snapshot(self, raw_data: dict):
+        tmp = self.storage_path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(raw_data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self.storage_path)
+
+
+    def _compact(self):
+        self._write_snapshot(self._snapshot())
+        self.old_journal_path.unlink(missing_ok=True)
+        self.journal_path.unlink(missing_ok=True)
+        self.pending_records = 0
+
+
+    async def compact(self):
+        if self._compacting or self.pending_records == 0:
+            return
+        self._compacting = True
+        try:
+            # Switch to a fresh journal so mutations can go on while the snapshot is written
+            self._journal.close()
+            try:
+                if self.old_journal_path.exists():
+                    # Left by a failed compaction, its records are not in the snapshot yet
+                    self._append_journal(self.journal_path, self.old_journal_path)
+                    self.journal_path.unlink()
+                else:
+                    self.journal_path.replace(self.old_journal_path)
+            finally:
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            compacted = self.pending_records
+
+            await asyncio.to_thread(self._write_snapshot, self._snapshot())
+            self.old_journal_path.unlink()
+            # Mutations made while the snapshot was written stay pending
+            self.pending_records -= compacted
+            logger.info(f'Compacted subscriptions storage at seq {self._seq}')
+        finally:
+            self._compacting = False
+
+
+    @staticmethod
+    def _append_journal(source: pathlib.Path, target: pathlib.Path):
+        with open(source, 'r', encoding='utf-8') as src, open(target, 'a', encoding='utf-8') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+
+    def close(self):
+        self._journal.close()
+
+
+    def all(self) -> dict[int, list[SubInfo]]:
+        return self.data
+
+
+    def get(self, chat_id: int) -> list[SubInfo]:
+        return self.data.get(chat_id, [])
+
+
+    def has(self, chat_id: int, task: str, lang: str) -> bool:
+        for sub in self.data.get(chat_id, []):
+            if sub.task == task and sub.lang == lang:
+                return True
+        return False
+
+
+    def due(self, first_minute: int, last_minute: int) -> list[tuple[int, SubInfo]]:
+        # Answered from the minute index, a restore chunk does not scan all subscriptions
+        return [item for minute in range(first_minute, last_minute + 1) for item in self._minutes.get(minute, {}).values()]
+
+
+    def add(self, chat_id: int, info: SubInfo):
+        self._commit({'op': 'add', 'chat_id': chat_id, 'sub': asdict(info)})
+
+
+    def remove(self, chat_id: int, task: str) -> SubInfo | None:
+        return self._commit({'op': 'remove', 'chat_id': chat_id, 'task': task})
+
+
+    def remove_all(self, chat_id: int) -> list[SubInfo]:
+        return self._commit({'op': 'remove_all', 'chat_id': chat_id})
+
+
+class SqliteStorage(SubStorage):
+    """
+    Subscriptions in a local SQLite database (WAL mode), indexed by chat and by UTC delivery minute.
+    """
+
+    COLUMNS = 'task, lang, hour, minute, timezone'
+
+    def __init__(self, data_dir: pathlib.Path):
+        self.db_path = data_dir / 'subs.db'
+        self.db = sqlite3.connect(self.db_path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS subs (
+                id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                task TEXT NOT NULL,
+                lang TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                minute INTEGER NOT NULL,
+                timezone INTEGER NOT NULL,
+                utc_minute INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS subs_chat_id ON subs (chat_id);
+            CREATE INDEX IF NOT EXISTS subs_utc_minute ON subs (utc_minute);
+        ''')
+        migrate_json_to_sqlite(data_dir, self)
+
+
+    def is_empty(self) -> bool:
+        return self.db.execute('SELECT 1 FROM subs LIMIT 1').fetchone() is None
+
+
+    def insert_many(self, rows: list[tuple[int, SubInfo]]):
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany(
+                f'INSERT INTO subs (chat_id, {self.COLUMNS}, utc_minute) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(chat_id, info.task, info.lang, info.hour, info.minute, info.timezone, info.utc_minute) for chat_id, info in rows]
+            )
+
+
+    def all(self) -> dict[int, list[SubInfo]]:
+        data = {}
+        for chat_id, *row in self.db.execute(f'SELECT chat_id, {self.COLUMNS} FROM subs ORDER BY id'):
+            data.setdefault(chat_id, []).append(SubInfo(*row))
+        return data
+
+
+    def get(self, chat_id: int) -> list[SubInfo]:
+        return [SubInfo(*row) for row in self.db.execute(f'SELECT {self.COLUMNS} FROM subs WHERE chat_id = ? ORDER BY id', (chat_id,))]
+
+
+    def has(self, chat_id: int, task: str, lang: str) -> bool:
+        return self.db.execute('SELECT 1 FROM subs WHERE chat_id = ? AND task = ? AND lang = ? LIMIT 1', (chat_id, task, lang)).fetchone() is not None
+
+
+    def due(self, first_minute: int, last_minute: int) -> list[tuple[int, SubInfo]]:
+        rows = self.db.execute(f'SELECT chat_id, {self.COLUMNS} FROM subs WHERE utc_minute BETWEEN ? AND ? ORDER BY utc_minute, id',
+                               (first_minute, last_minute))
+        return [(chat_id, SubInfo(*row)) for chat_id, *row in rows]
+
+
+    def add(self, chat_id: int, info: SubInfo):
+        self.insert_many([(chat_id, info)])
+
+
+    def remove(self, chat_id: int, task: str) -> SubInfo | None:
+        with self.db:
+            self.db.execute('BEGIN')
+            row = self.db.execute(f'SELECT id, {self.COLUMNS} FROM subs WHERE chat_id = ? AND task = ? ORDER BY id LIMIT 1', (chat_id, task)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('DELETE FROM subs WHERE id = ?', (row[0],))
+        return SubInfo(*row[1:])
+
+
+    def remove_all(self, chat_id: int) -> list[SubInfo]:
+        with self.db:
+            self.db.execute('BEGIN')
+            subs = self.get(chat_id)
+            self.db.execute('DELETE FROM subs WHERE chat_id = ?', (chat_id,))
+        return subs
+
+
+    async def compact(self):
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+    def close(self):
+        self.db.close()
+
+
+def migrate_json_to_sqlite(data_dir: pathlib.Path, db: SqliteStorage):
+    """
+    One-shot import of subs.json (and its journal) into an empty database.
+    The JSON files are kept with a .migrated suffix.
+    """
+    json_path = data_dir / 'subs.json'
+    if not json_path.exists() or not db.is_empty():
+        return
+
+    source = JournalStorage(data_dir) # replays and compacts the journal
+    source.close()
+    rows = [(chat_id, info) for chat_id, subs in source.all().items() for info in subs]
+    db.insert_many(rows)
+    json_path.replace(json_path.with_suffix('.json.migrated'))
+    source.journal_path.unlink(missing_ok=True)
+    logger.info(f'Migrated {len(rows)} subscriptions from {json_path} to {db.db_path}')
+
+
+STORAGES = {
+    'json': JournalStorage,
+    'sqlite': SqliteStorage,
+}
+assert tuple(STORAGES) == STORAGE_NAMES
+
+
+def open_storage(kind: str, data_dir: pathlib.Path) -> SubStorage:
+    with STORAGE_SECONDS.time('load'):
+        return STORAGES[kind](data_dir)
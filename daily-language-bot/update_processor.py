@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPDATES = 32
+MAX_PENDING_UPDATES = 4096 # updates processed or waiting for their chat at a time
+
+
+class KeyedLocks:
+    """
+    asyncio.Lock per key, dropped as soon as nobody holds or waits for it.
+    Waiters are served in arrival order.
+    """
+
+    def __init__(self):
+        self._locks: dict[Any, tuple[asyncio.Lock, int]] = {}
+
+
+    def __len__(self):
+        return len(self._locks)
+
+
+    @asynccontextmanager
+    async def hold(self, key):
+        lock, users = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently, up to max_concurrent_updates at a time,
+    while updates of the same chat - and of the same user, whose user_data holds conversation steps -
+    are processed one after another in the order they arrived.
+    Updates waiting for their chat do not take a processing slot, so one busy chat cannot block the others.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        # The base class limit is applied before do_process_update, so it only bounds the updates in flight.
+        # Application starts a task for every fetched update either way, the poller is not slowed down by it.
+        # The processing limit is applied in do_process_update, once the chat's turn has come
+        super().__init__(max(max_concurrent_updates, MAX_PENDING_UPDATES))
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chats = KeyedLocks()
+        self._users = KeyedLocks()
+
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        async with AsyncExitStack() as stack:
+            # Always chat before user, so two updates never wait for each other's locks
+            if isinstance(update, Update):
+                if update.effective_chat is not None:
+                    await stack.enter_async_context(self._chats.hold(update.effective_chat.id))
+                if update.effective_user is not None:
+                    await stack.enter_async_context(self._users.hold(update.effective_user.id))
+            async with self._running:
+                await coroutine
+
+
+    async def initialize(self) -> None:
+        pass
+
+
+    async def shutdown(self) -> None:
+        if len(self._chats) or len(self._users):
+            logger.warning(f'Shutting down with updates of {len(self._chats)} chats still being processed')
@@ -0,0 +1,166 @@
+import os
+import re
+import time
+import random
+import logging
+import pathlib
+from array import array
+from functools import cache
+from typing import NamedTuple
+
+
+logger = logging.getLogger(__name__)
+
+MTIME_CHECK_INTERVAL = 5 # seconds between checks of the file for changes
+
+
+def normalize_form(text: str) -> str:
+    return ' '.join(text.casefold().split())
+
+
+def _alternatives(text: str) -> frozenset[str]:
+    """
+    Accepted spellings of a catalogue field: 'was/were', 'geschrie(e)n', 'to command, to order'.
+    """
+    text = re.sub(r'\s*\([^)]*\s[^)]*\)', '', text) # remarks such as '(e.g. a place/person)'
+    forms = set()
+    for part in re.split(r'[/,]', text):
+        forms.add(normalize_form(re.sub(r'[()]', '', part))) # geschrieen
+        forms.add(normalize_form(re.sub(r'\(.*?\)', '', part))) # geschrien
+    forms.update(form[3:] for form in list(forms) if form.startswith('to '))
+    forms.discard('')
+    return frozenset(forms)
+
+
+class VerbForms(NamedTuple):
+    infinitive: str
+    past: frozenset[str]
+    participle: frozenset[str]
+    translation: frozenset[str]
+
+    @classmethod
+    def from_values(cls, values) -> 'VerbForms':
+        infinitive, past, participle, translation = (list(values) + [''] * 4)[:4]
+        return cls(normalize_form(infinitive), _alternatives(past), _alternatives(participle), _alternatives(translation))
+
+
+class VerbCatalogue:
+    """
+    Verb list of a language (one 'infinitive;past;participle;translation' entry per line).
+    The file is indexed by line offsets once and lines are read with pread, so sampling does not read or keep every line.
+    It is re-indexed when the file's mtime changes. The file may be rewritten in place at any time,
+    so an offset is only read after checking that the open file is still the one that was indexed.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._mtime_ns: int = None
+        self._checked_at = 0.0
+        self._file = None
+        self._starts = array('Q')
+        self._ends = array('Q')
+        self.version = 0 # incremented on every reload
+        self._index: dict[str, VerbForms] = None
+        self._refresh()
+
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._mtime_ns is not None and now - self._checked_at < MTIME_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        if os.stat(self.path).st_mtime_ns != self._mtime_ns:
+            self._load()
+
+
+    def _load(self):
+        file = open(self.path, 'rb')
+        mtime_ns = os.fstat(file.fileno()).st_mtime_ns
+        content = file.read() # only to find the line offsets, not kept
+
+        starts, ends = array('Q'), array('Q')
+        pos = 0
+        while pos < len(content):
+            end = content.find(b'\n', pos)
+            if end < 0:
+                end = len(content)
+            if content[pos:end].strip():
+                starts.append(pos)
+                ends.append(end)
+            pos = end + 1
+
+        if self._file is not None:
+            self._file.close()
+        self._file, self._mtime_ns, self._starts, self._ends = file, mtime_ns, starts, ends
+        self._index = None
+        self.version += 1
+        logger.info(f'Indexed {len(starts)} verbs in {self.path}')
+
+
+    def _read(self, index: int) -> str | None:
+        """
+        Line at index, None if the file was changed in place since it was indexed.
+        """
+        start, end = self._starts[index], self._ends[index]
+        fd = self._file.fileno()
+        stat = os.fstat(fd)
+        if stat.st_size < end or stat.st_mtime_ns != self._mtime_ns:
+            return None
+        return os.pread(fd, end - start, start).decode('utf-8', errors='replace').strip()
+
+
+    def __len__(self):
+        self._refresh()
+        return len(self._starts)
+
+
+    def line(self, index: int) -> str:
+        line = self._read(index)
+        if line is None:
+            self._load()
+            line = self._read(index) # IndexError if the file got shorter
+        return line
+
+
+    def random_line(self, rng: random.Random = random) -> str:
+        self._refresh()
+        line = self._read(rng.randrange(len(self._starts)))
+        if line is None:
+            self._load()
+            line = self._read(rng.randrange(len(self._starts)))
+        return line
+
+
+    def lines(self):
+        """
+        All entries, read sequentially from the current file rather than through the offsets.
+        """
+        with open(self.path, 'rb') as f:
+            for line in f:
+                line = line.decode('utf-8', errors='replace').strip()
+                if line:
+                    yield line
+
+
+    def forms(self, infinitive: str) -> VerbForms | None:
+        """
+        Accepted forms of a verb. The index over the whole file is built on first use and after a reload.
+        """
+        self._refresh()
+        if os.fstat(self._file.fileno()).st_mtime_ns != self._mtime_ns:
+            self._load() # changed in place since it was indexed
+        if self._index is None:
+            self._index = {}
+            for line in self.lines():
+                forms = VerbForms.from_values(line.split(';'))
+                self._index.setdefault(forms.infinitive, forms)
+        return self._index.get(normalize_form(infinitive))
+
+
+@cache
+def get_verb_catalogue(path: pathlib.Path) -> VerbCatalogue:
+    return VerbCatalogue(path)
+
+
+def verbs_path(data_dir: pathlib.Path, language: str) -> pathlib.Path:
+    return pathlib.Path(data_dir) / f'verbs_{language.lower()}.txt'
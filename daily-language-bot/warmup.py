@@ -0,0 +1,69 @@
+import os
+import logging
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .audio import clip_key, render_clip_sync, render_pause_sync
+from .clip_cache import get_clip_cache
+from .numbers_de import NUMBERS, NUMBER_RANGE
+from .verbs import get_verb_catalogue, verbs_path
+
+
+logger = logging.getLogger(__name__)
+
+
+def content_catalogue(data_dir: pathlib.Path) -> list[tuple[str, str]]:
+    """
+    Every (text, language) pair the daily tasks can voice.
+    """
+    items = []
+    for language, numbers in NUMBERS.items():
+        items.extend((numbers[n], language) for n in NUMBER_RANGE)
+
+        path = verbs_path(data_dir, language)
+        if not path.exists():
+            logger.warning(f'No verbs file at {path}, skipping verbs for {language}')
+            continue
+        for line in get_verb_catalogue(path).lines():
+            forms = line.split(';')[:3]
+            items.extend((form, language) for form in forms if form)
+
+    return list(dict.fromkeys(items))
+
+
+def _render(text: str, language: str, audio_dir: pathlib.Path):
+    render_clip_sync(text, language, get_clip_cache(audio_dir))
+
+
+def warmup(data_dir: pathlib.Path, workers: int = None):
+    """
+    Pre-render every clip of the content catalogue into the clip cache.
+    Clips already in the cache are skipped, so an interrupted run resumes where it stopped.
+    """
+    audio_dir = data_dir / 'audio'
+    cache = get_clip_cache(audio_dir)
+    render_pause_sync(cache)
+
+    catalogue = content_catalogue(data_dir)
+    todo = [(text, language) for text, language in catalogue if clip_key(text, language) not in cache]
+    logger.info(f'Warmup: {len(catalogue) - len(todo)}/{len(catalogue)} clips already cached, rendering {len(todo)}')
+    if not todo:
+        return
+
+    workers = workers or os.cpu_count() or 1
+    done, failed = 0, 0
+    step = max(1, len(todo) // 20)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_render, text, language, audio_dir): (text, language) for text, language in todo}
+        for future in as_completed(futures):
+            done += 1
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                logger.error(f'Failed to render {futures[future]}: {e}')
+            if done % step == 0 or done == len(todo):
+                logger.info(f'Warmup: {done}/{len(todo)} ({done * 100 // len(todo)}%), {failed} failed')
+
+    if failed:
+        logger.warning(f'Warmup finished with {failed} failed clips, run it again to retry them')
@@ -0,0 +1,36 @@
+import sys
+import pathlib
+import warnings
+import importlib
+from types import SimpleNamespace
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+conversation = importlib.import_module('daily-language-bot.conversation')
+subscribe_conversation = importlib.import_module('daily-language-bot.subscribe_conversation')
+
+
+def _build(cls):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # per_message warnings of python-telegram-bot
+        return cls(SimpleNamespace())
+
+
+def test_plain_method_overrides_step():
+    class PlainStart(subscribe_conversation.SubConversation):
+        async def start(self, update, context):
+            return conversation.ConversationHandler.END
+
+    assert 'start' in subscribe_conversation.SubConversation._step_names
+    assert 'start' not in PlainStart._step_names
+    assert _build(PlainStart).steps == _build(subscribe_conversation.SubConversation).steps
+
+
+def test_step_overrides_step():
+    class OtherStart(subscribe_conversation.SubConversation):
+        @conversation.conversation_step(-1)
+        async def start(self, update, context):
+            return conversation.ConversationHandler.END
+
+    assert OtherStart._step_names['start'] == -1
+    _build(OtherStart)
@@ -0,0 +1,52 @@
+import sys
+import asyncio
+import pathlib
+import importlib
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+file_id_cache = importlib.import_module('daily-language-bot.file_id_cache')
+
+
+def _lines(path: pathlib.Path) -> int:
+    return len(path.read_text(encoding='utf-8').splitlines())
+
+
+def test_log_is_compacted_while_running(tmp_path):
+    path = tmp_path / 'file_ids.jsonl'
+
+    async def churn():
+        cache = file_id_cache.FileIdCache(path)
+        for i in range(3 * file_id_cache.MIN_COMPACT_RECORDS):
+            cache.put(f'digest{i % 10}', f'id{i}')
+            if i % 100 == 0:
+                await asyncio.sleep(0)
+        while cache._compaction is not None:
+            await asyncio.sleep(0.01)
+        cache.put('last', 'id')
+        return cache
+
+    cache = asyncio.run(churn())
+    assert cache.records == _lines(path) <= file_id_cache.MIN_COMPACT_RECORDS + 1
+    reloaded = file_id_cache.FileIdCache(path)
+    assert reloaded.data == cache.data
+
+
+def test_changes_during_compaction_are_kept(tmp_path):
+    path = tmp_path / 'file_ids.jsonl'
+
+    async def compact_while_writing():
+        cache = file_id_cache.FileIdCache(path)
+        for i in range(10):
+            cache.put(f'digest{i}', 'old')
+        compaction = asyncio.create_task(cache.compact())
+        await asyncio.sleep(0)
+        cache.put('digest0', 'new')
+        cache.invalidate('digest1')
+        await compaction
+        return cache
+
+    cache = asyncio.run(compact_while_writing())
+    reloaded = file_id_cache.FileIdCache(path)
+    assert reloaded.data == cache.data
+    assert reloaded.get('digest0') == 'new' and reloaded.get('digest1') is None
@@ -0,0 +1,39 @@
+import sys
+import pathlib
+import importlib
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+numbers_de = importlib.import_module('daily-language-bot.numbers_de')
+checks = importlib.import_module('daily-language-bot.checks')
+
+
+@pytest.mark.parametrize('language', ['DE', 'EN'])
+def test_words_round_trip(language):
+    lexicon = numbers_de.LEXICONS[language]
+    for number in [*numbers_de.NUMBER_RANGE, 100, 101, 999, 1000, 1001, 12_345, numbers_de.MAX_NUMBER]:
+        assert lexicon.value(lexicon.words(number)) == number
+
+
+@pytest.mark.parametrize('language, text', [('DE', 'zweiunddreisig'), ('EN', 'thirty tow'), ('EN', ''), ('DE', '0')])
+def test_value_rejects_misspelled(language, text):
+    assert numbers_de.LEXICONS[language].value(text) is None
+
+
+def test_split_english_groups_words():
+    text = 'twenty one, thirty-two\nforty three fifty\n5 6 7'
+    assert checks.parse_numbers_answer(text, 'EN') == ['twenty one', 'thirty two', 'forty three', 'fifty', '5', '6', '7']
+
+
+def test_split_german_words():
+    text = 'einundzwanzig zweiunddreißig\nhundert; tausend\n5 6 7'
+    assert checks.parse_numbers_answer(text, 'de') == ['einundzwanzig', 'zweiunddreißig', 'hundert', 'tausend', '5', '6', '7']
+
+
+def test_split_keeps_misspelled_line_whole():
+    text = 'twenty one\nthirty tow\nforty three\n5 6 7\n1 2 3'
+    assert checks.parse_numbers_answer(text, 'EN') == ['twenty one', 'thirty tow', 'forty three', '5', '6', '7', '1', '2', '3']
+    text = 'einundzwanzig\nzwei und dreisig\n5 6 7'
+    assert checks.parse_numbers_answer(text, 'DE') == ['einundzwanzig', 'zwei und dreisig', '5', '6', '7']
@@ -0,0 +1,42 @@
+import sys
+import time
+import asyncio
+import pathlib
+import importlib
+from types import SimpleNamespace
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+scheduler = importlib.import_module('daily-language-bot.scheduler')
+sub_storage = importlib.import_module('daily-language-bot.sub_storage')
+
+
+class _App:
+    def __init__(self):
+        self.job_queue = SimpleNamespace(run_repeating=lambda *args, **kwargs: None)
+        self.delivered: list = []
+
+    def create_task(self, coroutine):
+        coroutine.close()
+        self.delivered.append(coroutine)
+
+
+def _ticks(data_dir: pathlib.Path) -> int:
+    # Builds a scheduler as after a (re)start, with a subscription due this minute, and ticks once
+    app = _App()
+    now = int(time.time() // 60)
+    minute = now % sub_storage.MINUTES_PER_DAY
+    delivery = scheduler.DeliveryScheduler(app, data_dir, {}, {})
+    delivery.add(1, sub_storage.SubInfo('numbers', 'DE', minute // 60, minute % 60, 0))
+    asyncio.run(delivery._tick(None))
+    return len(app.delivered)
+
+
+def test_minute_is_not_delivered_again_after_restart(tmp_path):
+    assert _ticks(tmp_path) == 1
+    assert _ticks(tmp_path) == 0
+
+
+def test_missed_minutes_are_caught_up_after_restart(tmp_path):
+    (tmp_path / 'last_tick').write_text(str(int(time.time() // 60) - 3))
+    assert _ticks(tmp_path) == 1
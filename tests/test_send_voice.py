@@ -0,0 +1,48 @@
+import sys
+import asyncio
+import pathlib
+import importlib
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+jobs = importlib.import_module('daily-language-bot.jobs')
+file_id_cache = importlib.import_module('daily-language-bot.file_id_cache')
+
+
+class _Bot:
+    def __init__(self, cached_error: str):
+        self.cached_error = cached_error
+        self.uploads = 0
+
+    async def send_voice(self, chat_id, voice, **kwargs):
+        if isinstance(voice, str):
+            raise BadRequest(self.cached_error)
+        self.uploads += 1
+        return SimpleNamespace(voice=SimpleNamespace(file_id='fresh'))
+
+
+def _context(tmp_path, error: str):
+    cache = file_id_cache.FileIdCache(tmp_path / 'file_ids.jsonl')
+    file_id_cache.set_file_id_cache(tmp_path, cache)
+    cache.put(cache.digest(b'track'), 'cached')
+    return cache, SimpleNamespace(bot=_Bot(error), job=SimpleNamespace(data={'data_dir': str(tmp_path)}))
+
+
+def test_rejected_file_id_is_replaced(tmp_path):
+    cache, context = _context(tmp_path, 'Wrong file identifier/http url specified')
+    asyncio.run(jobs.send_voice_track(context, 1, b'track', 3, 'track.ogg'))
+    assert context.bot.uploads == 1
+    assert cache.get(cache.digest(b'track')) == 'fresh'
+
+
+@pytest.mark.parametrize('error', ['Chat not found', 'Voice_messages_forbidden'])
+def test_chat_error_keeps_file_id(tmp_path, error):
+    cache, context = _context(tmp_path, error)
+    with pytest.raises(BadRequest):
+        asyncio.run(jobs.send_voice_track(context, 1, b'track', 3, 'track.ogg'))
+    assert context.bot.uploads == 0
+    assert cache.get(cache.digest(b'track')) == 'cached'
@@ -0,0 +1,82 @@
+import sys
+import asyncio
+import pathlib
+import importlib
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+sub_storage = importlib.import_module('daily-language-bot.sub_storage')
+
+
+def _sub(task: str, hour: int = 9) -> 'sub_storage.SubInfo':
+    return sub_storage.SubInfo(task=task, lang='DE', hour=hour, minute=0, timezone=1)
+
+
+def test_failed_compaction_is_retried(tmp_path, monkeypatch):
+    storage = sub_storage.JournalStorage(tmp_path)
+    storage.add(1, _sub('numbers'))
+    storage.add(2, _sub('verbs'))
+
+    def broken_snapshot(raw_data):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(storage, '_write_snapshot', broken_snapshot)
+    with pytest.raises(OSError):
+        asyncio.run(storage.compact())
+    assert storage.pending_records == 2
+    assert storage.old_journal_path.exists()
+
+    storage.add(3, _sub('numbers', 10))
+    monkeypatch.undo()
+    asyncio.run(storage.compact())
+    assert storage.pending_records == 0
+    assert not storage.old_journal_path.exists()
+    storage.close()
+
+    reloaded = sub_storage.JournalStorage(tmp_path)
+    assert reloaded.all() == storage.all()
+    assert sorted(reloaded.all()) == [1, 2, 3]
+    reloaded.close()
+
+
+def test_failed_compaction_survives_restart(tmp_path, monkeypatch):
+    storage = sub_storage.JournalStorage(tmp_path)
+    storage.add(1, _sub('numbers'))
+    monkeypatch.setattr(storage, '_write_snapshot', lambda raw_data: (_ for _ in ()).throw(OSError('disk full')))
+    with pytest.raises(OSError):
+        asyncio.run(storage.compact())
+    storage.add(2, _sub('verbs'))
+    storage.close()
+
+    reloaded = sub_storage.JournalStorage(tmp_path)
+    assert sorted(reloaded.all()) == [1, 2]
+    reloaded.close()
+
+
+def _scan(storage, first_minute: int, last_minute: int) -> list:
+    return sorted((chat_id, sub.task, sub.utc_minute) for chat_id, subs in storage.all().items() for sub in subs
+                  if first_minute <= sub.utc_minute <= last_minute)
+
+
+def _due(storage, first_minute: int, last_minute: int) -> list:
+    return sorted((chat_id, sub.task, sub.utc_minute) for chat_id, sub in storage.due(first_minute, last_minute))
+
+
+def test_due_follows_mutations(tmp_path):
+    storage = sub_storage.JournalStorage(tmp_path)
+    for chat_id in range(20):
+        storage.add(chat_id, _sub('numbers', chat_id % 24))
+        storage.add(chat_id, _sub('verbs', (chat_id + 5) % 24))
+    storage.remove(3, 'numbers')
+    storage.remove_all(4)
+    asyncio.run(storage.compact())
+    storage.add(30, _sub('verbs', 9))
+    storage.remove(5, 'verbs')
+    storage.close()
+
+    for current in (storage, sub_storage.JournalStorage(tmp_path)):
+        for first_minute, last_minute in [(0, sub_storage.MINUTES_PER_DAY - 1), (8 * 60, 8 * 60), (7 * 60, 12 * 60)]:
+            assert _due(current, first_minute, last_minute) == _scan(current, first_minute, last_minute)
+    assert (4, 'numbers', 3 * 60) not in _due(storage, 0, sub_storage.MINUTES_PER_DAY - 1)
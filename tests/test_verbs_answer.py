@@ -0,0 +1,48 @@
+import sys
+import pathlib
+import importlib
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+checks = importlib.import_module('daily-language-bot.checks')
+verbs = importlib.import_module('daily-language-bot.verbs')
+
+BEFEHLEN = verbs.VerbForms.from_values(['befehlen', 'befahl', 'befohlen', 'to command, to order'])
+SCHREIEN = verbs.VerbForms.from_values(['schreien', 'schrie', 'geschrie(e)n', 'to shout/to yell'])
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('ging, gegangen', ['ging', 'gegangen']),
+    ('gehen - ging - gegangen', ['ging', 'gegangen']),
+    ('ging gegangen', ['ging', 'gegangen']),
+    ('gehen ging gegangen', ['ging', 'gegangen']),
+    ('ging gegangen to go', ['ging', 'gegangen', 'to go']),
+    ('gehen ging gegangen to go', ['ging', 'gegangen', 'to go']),
+    ('ging', ['ging']),
+])
+def test_parse_verbs_answer(text, expected):
+    assert checks.parse_verbs_answer(text, 'gehen') == expected
+
+
+def test_parse_keeps_forms_equal_to_infinitive():
+    assert checks.parse_verbs_answer('put, put', 'put') == ['put', 'put']
+    assert checks.parse_verbs_answer('put put put to put', 'put') == ['put', 'put', 'to put']
+
+
+@pytest.mark.parametrize('forms, text', [
+    (BEFEHLEN, 'befahl, befohlen, to command, to order'),
+    (BEFEHLEN, 'befahl, befohlen, to order'),
+    (BEFEHLEN, 'befahl, befohlen, To Command / to demand'),
+    (SCHREIEN, 'schrie, geschrien, to shout / to yell'),
+    (SCHREIEN, 'schrie, geschrieen, to yell'),
+])
+def test_translation_accepted(forms, text):
+    answers = checks.parse_verbs_answer(text, forms.infinitive)
+    assert checks._translation_correct(answers[2:], forms.translation)
+
+
+def test_translation_rejected():
+    answers = checks.parse_verbs_answer('befahl, befohlen, to obey, to follow', 'befehlen')
+    assert not checks._translation_correct(answers[2:], BEFEHLEN.translation)